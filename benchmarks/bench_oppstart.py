@@ -0,0 +1,138 @@
+# Times a cold start of the app, each measurement in a fresh Python process with an
+# empty store:
+#   import_streamlit  what the Streamlit server has loaded before the first session
+#   forste_visning    the first run, up to the selectors and the upload prompt
+#   forste_graf       from choosing a workbook and a period to the first chart
+# Between the two runs the process waits --pause seconds, standing in for the user
+# picking a file while the app warms up in the background.
+#
+#   python benchmarks/bench_oppstart.py --ut oppstart.json
+#   python benchmarks/bench_oppstart.py --pause 0 --gjentak 5
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROT))
+
+ARK_MAPPE = Path(tempfile.gettempdir()) / "waterfall_bench_ark"
+GENERATOR = Path(__file__).resolve().parent / "syntetisk_arbeidsbok.py"
+STEG = ["import_streamlit", "forste_visning", "forste_graf"]
+
+# The script the app is run through: the app itself, with the upload answered by the
+# workbook in WATERFALL_BENCH_FIL once it is set
+INNPAKNING = """
+import io, os, sys
+import streamlit as st
+sys.path.insert(0, {rot!r})
+import waterfall_slakt_streamlit as app
+
+
+def _opplasting(*args, **kwargs):
+    sti = os.environ.get("WATERFALL_BENCH_FIL")
+    if not sti:
+        return []
+    fil = io.BytesIO(open(sti, "rb").read())
+    fil.name = fil.file_id = os.path.basename(sti)
+    return [fil]
+
+
+st.file_uploader = _opplasting
+app.main()
+"""
+
+
+def arbeidsbok(ark_type, maaneder):
+    # Generated once per size and kept between runs, until the generator changes
+    sti = ARK_MAPPE / f"{ark_type}_{maaneder}m_linje1.xlsx"
+    if not sti.exists() or sti.stat().st_mtime < GENERATOR.stat().st_mtime:
+        from syntetisk_arbeidsbok import lag_arbeidsbok
+        lag_arbeidsbok(sti, ark_type, dager=round(maaneder * 365.25 / 12), seed=0)
+    return sti
+
+
+def mal_oppstart(ark_type, fil, pause):
+    # Runs in the fresh process; prints the times as JSON
+    tider = {}
+    start = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    tider["import_streamlit"] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as mappe:
+        os.environ["WATERFALL_LAGER_DIR"] = os.path.join(mappe, "lager")
+        skript = Path(mappe) / "app.py"
+        skript.write_text(INNPAKNING.format(rot=str(ROT)))
+        at = AppTest.from_file(str(skript), default_timeout=600)
+
+        start = time.perf_counter()
+        at.run()
+        tider["forste_visning"] = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+
+        time.sleep(pause)
+        os.environ["WATERFALL_BENCH_FIL"] = str(fil)
+        start = time.perf_counter()
+        at.selectbox[0].select(ark_type)
+        at.selectbox[1].select("Egendefinert periode")
+        at.run()
+        tider["forste_graf"] = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        if not at.get("image"):
+            raise RuntimeError("Ingen graf ble tegnet")
+    print(json.dumps(tider))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Måler kald oppstart: første visning og første graf.")
+    parser.add_argument("--ark", choices=["slakt", "filet"], default="slakt")
+    parser.add_argument("--maaneder", type=int, default=12, help="Størrelsen på arbeidsboken i måneder")
+    parser.add_argument("--pause", type=float, default=3.0,
+                        help="Sekunder mellom første visning og opplasting (brukerens tid)")
+    parser.add_argument("--gjentak", type=int, default=3, help="Beste av så mange kalde starter")
+    parser.add_argument("--ut", type=Path, help="Skriv resultatene til denne JSON-filen")
+    parser.add_argument("--barn", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.barn:
+        mal_oppstart(args.ark, args.barn, args.pause)
+        return 0
+
+    fil = arbeidsbok(args.ark, args.maaneder)
+    beste = {}
+    for _ in range(args.gjentak):
+        kjoring = subprocess.run(
+            [sys.executable, __file__, "--barn", str(fil), "--ark", args.ark, "--pause", str(args.pause)],
+            capture_output=True, text=True)
+        if kjoring.returncode:
+            print(kjoring.stderr, file=sys.stderr)
+            return 1
+        tider = json.loads(kjoring.stdout.strip().splitlines()[-1])
+        for steg, tid in tider.items():
+            beste[steg] = min(beste.get(steg, tid), tid)
+
+    resultater = [{"ark": args.ark, "maaneder": args.maaneder, "pause": args.pause, "steg": steg,
+                   "sekunder": round(beste[steg], 4)} for steg in STEG]
+    for rad in resultater:
+        print(f"{rad['ark']:5} {rad['maaneder']:3} mnd  {rad['steg']:20} {rad['sekunder']:8.3f} s")
+
+    if args.ut:
+        args.ut.write_text(json.dumps({
+            "tidspunkt": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "maskin": platform.machine(),
+            "resultater": resultater,
+        }, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
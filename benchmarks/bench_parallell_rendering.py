@@ -0,0 +1,66 @@
+# Compares serial and process-pool rendering of waterfall charts on the bundled workbooks.
+#
+#   python benchmarks/bench_parallell_rendering.py [--maks 120] [--prosesser 4]
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+ROT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROT))
+
+import waterfall_slakt_streamlit as app
+from waterfall_grafer import lag_prosesspool, tegn_grafer
+
+ARBEIDSBOKER = [
+    (ROT / "excelark" / "inputslakt2907.xlsx", "slakt"),
+    (ROT / "excelark" / "inputfilet2907.xlsx", "filet"),
+]
+
+
+def lag_jobber(fil, ark_type):
+    # Every daily chart plus all weekly and monthly averages in the workbook
+    df = app.forbered_datasett(app.les_data(str(fil), ark_type), ark_type)
+
+    jobber = [app.graf_jobb(row, dag.date(), "enkeltgraf", ark_type) for dag, row in app.kpi_tabell(df).iterrows()]
+    jobber += [app.graf_jobb(row, uke, "ukesnitt", ark_type) for (_, uke), row in app.ukesnitt(df, ark_type).iterrows()]
+    jobber += [app.graf_jobb(row, f"{maned}/{år}", "manedsnitt", ark_type)
+               for (år, maned), row in app.manedsnitt(df, ark_type).iterrows()]
+    return jobber
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seriell mot parallell tegning av waterfall-grafer.")
+    parser.add_argument("--maks", type=int, default=120, help="Maks antall grafer per arbeidsbok (0 = alle)")
+    parser.add_argument("--prosesser", type=int, default=None, help="Antall prosesser (standard: antall CPU-er)")
+    args = parser.parse_args()
+    prosesser = args.prosesser or os.cpu_count()
+
+    with lag_prosesspool(prosesser) as pool:
+        # Start the workers (and their matplotlib import) before timing
+        start = time.perf_counter()
+        tegn_grafer([lag_jobber(*ARBEIDSBOKER[1])[0]] * prosesser, pool)
+        oppstart = time.perf_counter() - start
+        print(f"Oppstart av {prosesser} prosesser: {oppstart:.2f} s")
+
+        for fil, ark_type in ARBEIDSBOKER:
+            jobber = lag_jobber(fil, ark_type)
+            if args.maks:
+                jobber = jobber[:args.maks]
+
+            start = time.perf_counter()
+            serielt = tegn_grafer(jobber)
+            tid_serielt = time.perf_counter() - start
+
+            start = time.perf_counter()
+            parallelt = tegn_grafer(jobber, pool)
+            tid_parallelt = time.perf_counter() - start
+
+            assert [len(png) for png in serielt] == [len(png) for png in parallelt]
+            print(f"{fil.name}: {len(jobber)} grafer, serielt {tid_serielt:.2f} s, "
+                  f"parallelt {tid_parallelt:.2f} s, {tid_serielt / tid_parallelt:.1f}x raskere")
+
+
+if __name__ == "__main__":
+    main()
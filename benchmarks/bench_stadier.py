@@ -0,0 +1,168 @@
+# Times loading, computing and rendering separately on synthetic workbooks of growing
+# size, so it shows how each stage scales. Results are written as JSON; given a
+# baseline file from an earlier run, stages that got slower than the threshold are
+# listed and the exit code is 1.
+#
+#   python benchmarks/bench_stadier.py --ut resultater.json
+#   python benchmarks/bench_stadier.py --maaneder 1 12 60 --linjer 8 --baseline resultater.json
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROT))
+
+import pandas as pd
+
+import waterfall_slakt_streamlit as app
+from syntetisk_arbeidsbok import lag_arbeidsbok
+from waterfall_grafer import lag_prosesspool, tegn_grafer, tegn_maned_oversikt_png
+from waterfall_innlesing import les_arbeidsboker
+
+ARK_MAPPE = Path(tempfile.gettempdir()) / "waterfall_bench_ark"
+GENERATOR = Path(__file__).resolve().parent / "syntetisk_arbeidsbok.py"
+
+
+def ta_tid(funksjon, gjentak):
+    # Best of gjentak runs, and the result of the last one
+    beste = None
+    for _ in range(gjentak):
+        start = time.perf_counter()
+        resultat = funksjon()
+        tid = time.perf_counter() - start
+        beste = tid if beste is None else min(beste, tid)
+    return beste, resultat
+
+
+def arbeidsbok(ark_type, maaneder, linje=0):
+    # Generated once per size and kept between runs, until the generator changes
+    sti = ARK_MAPPE / f"{ark_type}_{maaneder}m_linje{linje + 1}.xlsx"
+    if not sti.exists() or sti.stat().st_mtime < GENERATOR.stat().st_mtime:
+        lag_arbeidsbok(sti, ark_type, dager=round(maaneder * 365.25 / 12), seed=linje)
+    return sti
+
+
+def uke_rapporter(df, ark_type):
+    # Data side of uke() for every production week: the days, the daily KPIs and the
+    # chart arguments of each day plus the weekly average
+    uker = app.ukesnitt(df, ark_type)
+    jobber = []
+    for år, uke in uker.index:
+        dager = app.kpi_tabell(app.hent_uke_dager(df, år, uke))
+        jobber += [app.graf_jobb(row, dag.date(), "enkeltgraf", ark_type) for dag, row in dager.iterrows()]
+        jobber.append(app.graf_jobb(uker.loc[(år, uke)], uke, "ukesnitt", ark_type))
+    return jobber
+
+
+def maned_rapporter(df, ark_type):
+    # Data side of maned() for every month
+    maneder = app.manedsnitt(df, ark_type)
+    jobber = []
+    for år, maned in maneder.index:
+        dager = app.kpi_tabell(app.hent_maned_dager(df, år, maned))
+        jobber += [app.graf_jobb(row, dag.date(), "enkeltgraf", ark_type) for dag, row in dager.iterrows()]
+        jobber.append(app.graf_jobb(maneder.loc[(år, maned)], f"{app.MANEDSNAVN[maned - 1]} {år}", "manedsnitt",
+                                    ark_type))
+    return jobber
+
+
+def mal_storrelse(ark_type, maaneder, args, pool):
+    fil = arbeidsbok(ark_type, maaneder)
+    tider = {}
+
+    tider["les_data"], ra_df = ta_tid(lambda: app.les_data(str(fil), ark_type), args.gjentak)
+    normalisert = app.normaliser_datoer(ra_df.copy())
+    tider["beregn_stopptid"], _ = ta_tid(lambda: app.beregn_stopptid_alle(normalisert, ark_type), args.gjentak)
+    tider["beregn_produksjon"], _ = ta_tid(lambda: app.beregn_produksjon_alle(normalisert, ark_type), args.gjentak)
+    tider["forbered_datasett"], df = ta_tid(lambda: app.forbered_datasett(ra_df.copy(), ark_type), args.gjentak)
+
+    tider["uke"], uke_jobber = ta_tid(lambda: uke_rapporter(df, ark_type), args.gjentak)
+    tider["maned"], _ = ta_tid(lambda: maned_rapporter(df, ark_type), args.gjentak)
+
+    # Rendering does not depend on the size of the sheet, so only the first charts are drawn
+    jobber = uke_jobber[:args.grafer]
+    tider["lag_graph"], _ = ta_tid(lambda: tegn_grafer(jobber), 1)
+    if pool is not None:
+        tider["lag_graph_parallelt"], _ = ta_tid(lambda: tegn_grafer(jobber, pool), 1)
+    forste_maned = df.index[0]
+    dager = app.kpi_tabell(app.hent_maned_dager(df, forste_maned.year, forste_maned.month))
+    tider["manedsoversikt"], _ = ta_tid(
+        lambda: tegn_maned_oversikt_png(
+            tuple((f"{dag.day}.{dag.month}.", float(row['stopptid_takt']), float(row['faktisk_takt']),
+                   float(row['annet'])) for dag, row in dager.iterrows()),
+            "Månedsoversikt", ark_type, app.OEE_100[ark_type], app.STIPLET_HOYDE[ark_type]), 1)
+
+    if args.linjer > 1:
+        filer = [arbeidsbok(ark_type, maaneder, linje) for linje in range(args.linjer)]
+        tider["les_linjer"], _ = ta_tid(lambda: les_arbeidsboker(filer, ark_type, pool), 1)
+
+    return [{"ark": ark_type, "maaneder": maaneder, "dager": len(df), "grafer": len(jobber),
+             "linjer": args.linjer, "steg": steg, "sekunder": round(tid, 4)}
+            for steg, tid in tider.items()]
+
+
+def finn_regresjoner(resultater, baseline, terskel):
+    nokkel = ["ark", "maaneder", "linjer", "steg"]
+    gammel = pd.DataFrame(baseline["resultater"]).set_index(nokkel)["sekunder"]
+    ny = pd.DataFrame(resultater).set_index(nokkel)["sekunder"]
+    felles = ny.index.intersection(gammel.index)
+    forhold = ny[felles] / gammel[felles]
+    return forhold[forhold > 1 + terskel].sort_values(ascending=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Måler innlesing, beregning og tegning hver for seg.")
+    parser.add_argument("--ark", nargs="+", choices=["slakt", "filet"], default=["slakt", "filet"])
+    parser.add_argument("--maaneder", nargs="+", type=int, default=[1, 12, 36], help="Størrelser i måneder")
+    parser.add_argument("--linjer", type=int, default=1, help="Mål også innlesing av så mange arbeidsbøker")
+    parser.add_argument("--grafer", type=int, default=20, help="Antall grafer som tegnes per størrelse")
+    parser.add_argument("--gjentak", type=int, default=3, help="Beste av så mange kjøringer (ikke for tegning)")
+    parser.add_argument("--prosesser", type=int, help="Mål også tegning og innlesing i en prosesspool")
+    parser.add_argument("--ut", type=Path, help="Skriv resultatene til denne JSON-filen")
+    parser.add_argument("--baseline", type=Path, help="Sammenlign med resultatene fra en tidligere kjøring")
+    parser.add_argument("--terskel", type=float, default=0.25, help="Tillatt økning i tid før det regnes som regresjon")
+    args = parser.parse_args()
+
+    resultater = []
+    pool = lag_prosesspool(args.prosesser) if args.prosesser else None
+    try:
+        if pool is not None:
+            # Start the workers before anything is timed
+            tegn_grafer([(1.0, 1.0, 1.0, "", "", "slakt", 150, 120)] * args.prosesser, pool)
+        for ark_type in args.ark:
+            for maaneder in args.maaneder:
+                for rad in mal_storrelse(ark_type, maaneder, args, pool):
+                    resultater.append(rad)
+                    print(f"{rad['ark']:5} {rad['maaneder']:3} mnd ({rad['dager']:4} dager)  "
+                          f"{rad['steg']:20} {rad['sekunder']:8.3f} s")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if args.ut:
+        args.ut.write_text(json.dumps({
+            "tidspunkt": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "maskin": platform.machine(),
+            "resultater": resultater,
+        }, indent=2, ensure_ascii=False))
+
+    if args.baseline:
+        regresjoner = finn_regresjoner(resultater, json.loads(args.baseline.read_text()), args.terskel)
+        if len(regresjoner):
+            print(f"\nTregere enn {args.baseline} (mer enn {args.terskel:.0%}):")
+            for (ark_type, maaneder, linjer, steg), forhold in regresjoner.items():
+                print(f"  {ark_type} {maaneder} mnd {steg}: {forhold:.2f}x")
+            return 1
+        print(f"\nIngen regresjoner mot {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+# Writes synthetic input-slakt / input-filet workbooks with the layout the app reads:
+# title on row 1, header on row 3, one production day per row from row 4, times in
+# the start/end columns, stop minutes in the SKJEMA stop columns and,
+# for slakt, end times after midnight written as 23:59/00:00 with the real end time
+# in a comment in column D. The same seed always gives the same workbook.
+#
+#   python benchmarks/syntetisk_arbeidsbok.py --ark slakt --maaneder 36 --linjer 4 --ut /tmp/arbeidsboker
+import argparse
+import random
+import sys
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.comments import Comment
+
+from waterfall_innlesing import SKJEMA, stoppkolonner
+
+# Number of columns, column positions and typical values per sheet type. The SKJEMA
+# stop headers are written at the skjema_stopp positions, as in the real sheets; the
+# other stop columns are ones the app does not count.
+OPPSETT = {
+    "slakt": {
+        "kolonner": 61, "start": 2, "slutt": 3, "antall_fisk": 5, "planlagt": 6,
+        "stopp": list(range(27, 51)), "skjema_stopp": list(range(27, 31)) + list(range(34, 51)),
+        "starttid": time(6, 45),
+        "arbeidstid": (6 * 60, 9 * 60), "fisk": (28000, 35000),
+    },
+    "filet": {
+        "kolonner": 52, "start": 6, "slutt": 7, "antall_fisk": 12, "planlagt": 14,
+        "stopp": list(range(30, 52)), "skjema_stopp": list(range(32, 52)),
+        "starttid": time(6, 45),
+        "arbeidstid": (10 * 60, 16 * 60), "fisk": (9000, 16000),
+    },
+}
+FORFATTERE = ["Hansen, Kari", "Olsen, Per", "Johansen, Ingrid", "Larsen, Ola"]
+
+
+def overskrifter(ark_type):
+    oppsett = OPPSETT[ark_type]
+    navn = [f"Kolonne{i + 1}" for i in range(oppsett["kolonner"])]
+    navn[0] = "Dato"
+    navn[1] = "Skift (velg 1 eller 2)"
+    navn[oppsett["start"]] = SKJEMA[ark_type]["start"]
+    navn[oppsett["slutt"]] = SKJEMA[ark_type]["slutt"]
+    navn[oppsett["antall_fisk"]] = SKJEMA[ark_type]["antall_fisk"]
+    navn[oppsett["planlagt"]] = "Antall fisk planlagt pakket [antall fisk]"
+    for nr, i in enumerate(oppsett["stopp"], start=1):
+        navn[i] = f"Stopp {nr}: Uforutsett stopp > 10 minutter [minutter]"
+    for i, kolonne in zip(oppsett["skjema_stopp"], stoppkolonner(ark_type)):
+        navn[i] = kolonne
+    return navn
+
+
+def lag_rader(ark_type, fra, dager, tilfeldig):
+    # (cell values, comment text for the end time or None) per production day.
+    # Weekends and about 5% of the weekdays have no production.
+    oppsett = OPPSETT[ark_type]
+    for n in range(dager):
+        dag = fra + timedelta(days=n)
+        if dag.weekday() >= 5 or tilfeldig.random() < 0.05:
+            continue
+        rad = [None] * oppsett["kolonner"]
+        rad[0] = datetime.combine(dag, time())
+        rad[1] = tilfeldig.choice([1, 2])
+
+        start = datetime.combine(dag, oppsett["starttid"]) + timedelta(minutes=tilfeldig.choice([0, 0, 15, 30]))
+        slutt = start + timedelta(minutes=5 * (tilfeldig.randint(*oppsett["arbeidstid"]) // 5))
+        rad[oppsett["start"]] = start.time()
+
+        kommentar = None
+        if slutt.date() > dag or tilfeldig.random() < 0.06:
+            # Finished after midnight: 23:59 or 00:00 in the cell and the real end in a comment
+            if slutt.date() == dag:
+                slutt = datetime.combine(dag + timedelta(days=1), time(0, 5 * tilfeldig.randint(0, 11)))
+            rad[oppsett["slutt"]] = tilfeldig.choice([time(23, 59), time(0, 0)])
+            if ark_type == "slakt" and tilfeldig.random() < 0.9:
+                forfatter = tilfeldig.choice(FORFATTERE)
+                if tilfeldig.random() < 0.8:
+                    kommentar = f"{forfatter}:\nSluttid neste dag: kl: {slutt:%H%M}"
+                else:
+                    kommentar = f"{forfatter}:\nferdig {slutt:%H:%M}"
+        else:
+            rad[oppsett["slutt"]] = slutt.time()
+
+        rad[oppsett["planlagt"]] = 1000 * (tilfeldig.randint(*oppsett["fisk"]) // 1000)
+        rad[oppsett["antall_fisk"]] = tilfeldig.randint(*oppsett["fisk"])
+        for i in oppsett["stopp"]:
+            trekk = tilfeldig.random()
+            if trekk < 0.03:
+                rad[i] = 5 * tilfeldig.randint(2, 24)
+            elif trekk < 0.6:
+                rad[i] = 0
+        if tilfeldig.random() < 0.01:
+            # Now and then someone writes text in a stop column
+            rad[tilfeldig.choice(oppsett["stopp"])] = "ca 20 min"
+        yield rad, kommentar
+
+
+def lag_arbeidsbok(sti, ark_type, fra=date(2021, 1, 4), dager=365, seed=0):
+    tilfeldig = random.Random(f"{ark_type}-{seed}")
+    oppsett = OPPSETT[ark_type]
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Dag")
+    ws.append([f"Input for {ark_type} per skift"])
+    ws.append([None] * oppsett["stopp"][0] + ["| STOPPTIDER -->"])
+    ws.append(overskrifter(ark_type))
+
+    formater = {0: "mm-dd-yy", oppsett["start"]: "hh:mm;@", oppsett["slutt"]: "hh:mm;@"}
+    for rad, kommentar in lag_rader(ark_type, fra, dager, tilfeldig):
+        celler = []
+        for i, verdi in enumerate(rad):
+            celle = WriteOnlyCell(ws, verdi)
+            if i in formater:
+                celle.number_format = formater[i]
+            if i == oppsett["slutt"] and kommentar is not None:
+                celle.comment = Comment(kommentar, kommentar.split(":")[0])
+            celler.append(celle)
+        ws.append(celler)
+
+    sti = Path(sti)
+    sti.parent.mkdir(parents=True, exist_ok=True)
+    wb.save(sti)
+    return sti
+
+
+def lag_linjer(mappe, ark_type, linjer, fra=date(2021, 1, 4), dager=365, seed=0):
+    # One workbook per line, with different data per line
+    return [lag_arbeidsbok(Path(mappe) / f"linje{n + 1}_input-{ark_type}.xlsx", ark_type, fra, dager, seed + n)
+            for n in range(linjer)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lager syntetiske input-slakt/input-filet-ark.")
+    parser.add_argument("--ark", choices=["slakt", "filet"], required=True)
+    parser.add_argument("--maaneder", type=int, default=12, help="Antall måneder med produksjon")
+    parser.add_argument("--fra", type=date.fromisoformat, default=date(2021, 1, 4), help="Første dag (ÅÅÅÅ-MM-DD)")
+    parser.add_argument("--linjer", type=int, default=1, help="Antall arbeidsbøker, én per linje")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ut", type=Path, default=Path("syntetiske_ark"), help="Mappe arkene skrives til")
+    args = parser.parse_args()
+
+    dager = round(args.maaneder * 365.25 / 12)
+    for sti in lag_linjer(args.ut, args.ark, args.linjer, args.fra, dager, args.seed):
+        print(sti)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# waterfall_api against a local server on a free port, serving the workbooks in
+# excelark/: the JSON tables, charts, ETags and the error paths.
+#
+#   python -m pytest tests
+import json
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+import pytest
+import uvicorn
+
+ROT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROT))
+
+import waterfall_api
+
+ARBEIDSBOKER = {
+    "slakt": ROT / "excelark" / "inputslakt2907.xlsx",
+    "filet": ROT / "excelark" / "inputfilet2907.xlsx",
+}
+
+
+@pytest.fixture(scope="module")
+def server():
+    kontakt = socket.socket()
+    kontakt.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(waterfall_api.lag_api(ARBEIDSBOKER), log_level="warning"))
+    trad = threading.Thread(target=server.run, kwargs={"sockets": [kontakt]}, daemon=True)
+    trad.start()
+    # Both workbooks are read before the server accepts requests
+    frist = time.monotonic() + 120
+    while not server.started:
+        assert trad.is_alive() and time.monotonic() < frist, "serveren startet ikke"
+        time.sleep(0.1)
+    yield f"http://127.0.0.1:{kontakt.getsockname()[1]}"
+    server.should_exit = True
+    trad.join(timeout=30)
+
+
+def hent(url, **hoder):
+    # (status, headers, body), also for error responses. "år" is sent percent-encoded.
+    url = urllib.parse.quote(url, safe=":/?&=")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=hoder), timeout=120) as svar:
+            return svar.status, svar.headers, svar.read()
+    except urllib.error.HTTPError as feil:
+        return feil.code, feil.headers, feil.read()
+
+
+def hent_json(url):
+    status, _, innhold = hent(url)
+    assert status == 200, innhold
+    return json.loads(innhold)
+
+
+def test_oversikt(server):
+    oversikt = hent_json(server + "/")
+    assert set(oversikt["ark"]) == {"slakt", "filet"}
+    assert oversikt["ark"]["slakt"]["fil"] == "inputslakt2907.xlsx"
+    assert oversikt["ark"]["slakt"]["dager"] > 0
+
+
+def test_tabeller(server):
+    dager = hent_json(server + "/slakt/dager")
+    assert dager["ark"] == "slakt" and dager["oee_100"] == waterfall_api.app.OEE_100["slakt"]
+    assert dager["rader"] and {"Dato", "gyldig", "stopptid_takt", "faktisk_takt", "annet"} <= set(dager["rader"][0])
+
+    forste = dager["rader"][0]["Dato"]
+    utvalg = hent_json(f"{server}/slakt/dager?fra={forste}&til={forste}")
+    assert [rad["Dato"] for rad in utvalg["rader"]] == [forste]
+
+    år = int(hent_json(server + "/filet/dager")["rader"][-1]["Dato"][:4])
+    uker = hent_json(f"{server}/filet/uker?år={år}")["rader"]
+    assert uker and all(rad["uke_år"] == år for rad in uker)
+    assert hent_json(server + "/slakt/maneder")["rader"]
+    assert "rader" in hent_json(server + "/filet/kvalitet")
+
+
+def test_grafer(server):
+    dag = next(rad["Dato"] for rad in hent_json(server + "/slakt/dager")["rader"] if rad["gyldig"])
+    status, hoder, png = hent(f"{server}/slakt/dager/{dag}.png")
+    assert status == 200 and hoder["Content-Type"] == "image/png"
+    assert png.startswith(b"\x89PNG")
+
+    status, hoder, svg = hent(f"{server}/slakt/maneder/{dag[:7]}.svg")
+    assert status == 200 and hoder["Content-Type"] == "image/svg+xml"
+    assert b"<svg" in svg[:500]
+
+
+def test_etag(server):
+    dag = next(rad["Dato"] for rad in hent_json(server + "/slakt/dager")["rader"] if rad["gyldig"])
+    for sti in ["/slakt/dager", f"/slakt/dager/{dag}.png"]:
+        status, hoder, _ = hent(server + sti)
+        assert status == 200 and hoder["ETag"]
+        status, _, innhold = hent(server + sti, **{"If-None-Match": hoder["ETag"]})
+        assert status == 304 and innhold == b""
+        status, _, _ = hent(server + sti, **{"If-None-Match": '"noe annet"'})
+        assert status == 200
+
+
+@pytest.mark.parametrize("sti, status", [
+    ("/slakt/dager?fra=2024-13-01", 400),
+    ("/slakt/uker?år=x", 400),
+    ("/slakt/timer", 404),
+    ("/torsk/dager", 404),
+    ("/slakt/dager/1999-01-01.png", 404),
+    ("/slakt/dager/2024-09-26.gif", 404),
+])
+def test_feil(server, sti, status):
+    svar, hoder, innhold = hent(server + sti)
+    assert svar == status
+    assert hoder["Content-Type"] == "application/json" and json.loads(innhold)["feil"]
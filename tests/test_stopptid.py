@@ -0,0 +1,63 @@
+# The vectorized stop time of forbered_datasett against the per-row beregn_stopptid
+# the app used before, on the workbooks in excelark/.
+#
+#   python -m pytest tests
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROT))
+
+import waterfall_slakt_streamlit as app
+from waterfall_innlesing import les_arbeidsbok
+
+ARBEIDSBOKER = [
+    ("slakt", ROT / "excelark" / "inputslakt2907.xlsx"),
+    ("filet", ROT / "excelark" / "inputfilet2907.xlsx"),
+]
+
+
+def beregn_stopptid(row, ark_type):
+    # As in the original app, on a row of pd.read_excel(header=2); a row it could
+    # not sum was rejected (None)
+    try:
+        if ark_type == "slakt":
+            stopptid = (
+                row.iloc[27:31].fillna(0).sum() +
+                row.iloc[34:40].fillna(0).sum() / 6 +
+                row.iloc[40:51].fillna(0).sum()
+            )
+        elif ark_type == "filet":
+            stopptid = row.iloc[32:52].fillna(0).sum()
+        return float(stopptid)
+    except Exception:
+        return None
+
+
+def referanse(sti, ark_type):
+    # Stop time per production date, the first row of a date winning like the old lookups.
+    # The old app always read the header from row 3; here it is the row starting with
+    # "Dato", which is row 2 in the slakt workbook.
+    forste_kolonne = pd.read_excel(sti, header=None, usecols=[0]).iloc[:, 0]
+    df = pd.read_excel(sti, header=int((forste_kolonne == "Dato").idxmax()))
+    dato = pd.to_datetime(df.iloc[:, 0], errors="coerce")
+    df = df[dato.notna().to_numpy()]
+    stopptid = [beregn_stopptid(row, ark_type) for _, row in df.iterrows()]
+    serie = pd.Series([np.nan if verdi is None else verdi for verdi in stopptid],
+                      index=pd.DatetimeIndex(dato[dato.notna()]).normalize().as_unit("ns"), dtype=float)
+    return serie[~serie.index.duplicated(keep="first")].sort_index()
+
+
+@pytest.mark.parametrize("ark_type, sti", ARBEIDSBOKER, ids=[ark_type for ark_type, _ in ARBEIDSBOKER])
+def test_stopptid_som_per_rad(ark_type, sti):
+    forventet = referanse(sti, ark_type)
+    stopptid = app.forbered_datasett(les_arbeidsbok(sti.read_bytes(), ark_type), ark_type)['stopptid']
+
+    assert stopptid.index.equals(forventet.index)
+    # The same rows rejected
+    assert np.array_equal(stopptid.isna().to_numpy(), forventet.isna().to_numpy())
+    np.testing.assert_allclose(stopptid.dropna().to_numpy(), forventet.dropna().to_numpy(), rtol=0, atol=1e-6)
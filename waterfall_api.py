@@ -0,0 +1,285 @@
+# Local HTTP API serving the waterfall numbers and charts to scripts, e.g. the
+# presentation pipeline. The workbooks are read once at startup and again when they
+# change on disk, and results are kept in memory. Every response carries an ETag; a
+# request whose If-None-Match matches gets 304 without the result being made or sent.
+#
+#   python waterfall_api.py --slakt "1. InputSlakt.xlsx" --filet "1. InputFilet.xlsx" --port 8502
+#
+#   GET /                                           sheet types served and their versions
+#   GET /slakt/dager?fra=2024-09-01&til=2024-09-30  daily KPIs as JSON
+#   GET /slakt/uker?år=2024                         weekly averages as JSON
+#   GET /slakt/maneder?år=2024                      monthly averages as JSON
+#   GET /slakt/kvalitet                             days left out by the quality checks
+#   GET /slakt/dager/2024-09-26.png                 charts (png, svg or pdf), named as
+#   GET /slakt/uker/2024-U40.svg                    the files waterfall_batch.py writes
+#   GET /slakt/maneder/2024-09.png
+import argparse
+import asyncio
+import hashlib
+import json
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from datetime import date
+from functools import partial
+from pathlib import Path
+
+import pandas as pd
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import waterfall_slakt_streamlit as app
+from waterfall_batch import fingeravtrykk, finn_grafer
+from waterfall_grafer import lag_prosesspool, tegn_graf_png
+from waterfall_innlesing import les_arbeidsbok
+
+TABELLER = ["dager", "uker", "maneder", "kvalitet"]
+MEDIETYPER = {"png": "image/png", "svg": "image/svg+xml", "pdf": "application/pdf"}
+SVARCACHE_BYTES = app.GRAFCACHE_BYTES
+
+
+class ApiFeil(Exception):
+    def __init__(self, status, melding):
+        super().__init__(melding)
+        self.status = status
+
+
+def filstatus(sti):
+    status = Path(sti).stat()
+    return status.st_mtime_ns, status.st_size
+
+
+def last_datasett(sti, ark_type):
+    # Everything served for one workbook: the KPI tables as in the export, and the
+    # tegn_graf_png arguments of every chart keyed by its batch file name
+    status = filstatus(sti)
+    data = Path(sti).read_bytes()
+    df = app.forbered_datasett(les_arbeidsbok(data, ark_type), ark_type)
+    return {
+        "fil": Path(sti).name,
+        "status": status,
+        "versjon": hashlib.sha256(data).hexdigest()[:16],
+        "dager": len(df),
+        "tabeller": app.eksport_tabeller(df, ark_type),
+        "grafer": dict(finn_grafer(df, ark_type)),
+    }
+
+
+def tabell_json(datasett, ark_type, navn, fra=None, til=None, år=None):
+    tabell = datasett["tabeller"][navn]
+    if navn in ("dager", "kvalitet"):
+        if fra is not None:
+            tabell = tabell[tabell['Dato'] >= pd.Timestamp(fra)]
+        if til is not None:
+            tabell = tabell[tabell['Dato'] <= pd.Timestamp(til)]
+        tabell = tabell.assign(Dato=tabell['Dato'].dt.strftime("%Y-%m-%d"))
+    elif år is not None:
+        tabell = tabell[tabell['uke_år' if navn == "uker" else 'år'] == år]
+    svar = {
+        "ark": ark_type,
+        "versjon": datasett["versjon"],
+        "oee_100": app.OEE_100[ark_type],
+        "stiplet_hoyde": app.STIPLET_HOYDE[ark_type],
+        # to_json writes NaN as null
+        "rader": json.loads(tabell.to_json(orient="records", force_ascii=False, double_precision=15)),
+    }
+    return json.dumps(svar, ensure_ascii=False).encode("utf-8")
+
+
+def lag_etag(*deler):
+    return '"' + hashlib.sha256(repr(deler).encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def ikke_endret(request, etag):
+    etager = request.headers.get("if-none-match")
+    if not etager:
+        return False
+    etager = [e.strip().removeprefix("W/") for e in etager.split(",")]
+    return "*" in etager or etag in etager
+
+
+def hoder(etag):
+    # Clients may keep the result but must ask again, with If-None-Match, before using it
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+async def hent_datasett(tilstand, ark_type):
+    # The warm dataset of ark_type, read again first if the workbook has changed.
+    # A workbook that can no longer be read leaves the last good version in place,
+    # and is not tried again until it changes.
+    sti = tilstand.arbeidsboker.get(ark_type)
+    if sti is None:
+        raise ApiFeil(404, f"Ingen arbeidsbok for {ark_type}")
+    async with tilstand.lasing[ark_type]:
+        datasett = tilstand.datasett.get(ark_type)
+        status = None
+        try:
+            status = filstatus(sti)
+            if datasett is None or status not in (datasett["status"], tilstand.feilet.get(ark_type)):
+                datasett = await run_in_threadpool(last_datasett, sti, ark_type)
+                tilstand.datasett[ark_type] = datasett
+        except Exception as e:
+            tilstand.feilet[ark_type] = status
+            if datasett is None:
+                raise ApiFeil(503, f"Kunne ikke lese {sti}: {e}")
+            print(f"Feil: Kunne ikke lese {sti} på nytt, bruker forrige versjon: {e}", file=sys.stderr)
+    return datasett
+
+
+def _ferdig(tilstand, etag, jobb):
+    del tilstand.venter[etag]
+    if not jobb.cancelled() and jobb.exception() is None:
+        tilstand.svar[etag] = jobb.result()
+        tilstand.svar_bytes += len(tilstand.svar[etag])
+        while tilstand.svar_bytes > SVARCACHE_BYTES:
+            _, gammelt = tilstand.svar.popitem(last=False)
+            tilstand.svar_bytes -= len(gammelt)
+
+
+async def hent_svar(tilstand, etag, lag):
+    # The response body for etag, made by awaiting lag() the first time. Requests for
+    # a result that is being made wait for the same job.
+    innhold = tilstand.svar.get(etag)
+    if innhold is not None:
+        tilstand.svar.move_to_end(etag)
+        return innhold
+    jobb = tilstand.venter.get(etag)
+    if jobb is None:
+        jobb = asyncio.ensure_future(lag())
+        tilstand.venter[etag] = jobb
+        jobb.add_done_callback(partial(_ferdig, tilstand, etag))
+    # A client that disconnects does not cancel the job for the others
+    return await asyncio.shield(jobb)
+
+
+async def oversikt(request):
+    tilstand = request.app.state
+    ark = {}
+    for ark_type in tilstand.arbeidsboker:
+        datasett = await hent_datasett(tilstand, ark_type)
+        ark[ark_type] = {"fil": datasett["fil"], "versjon": datasett["versjon"], "dager": datasett["dager"]}
+    return JSONResponse({"ark": ark, "tabeller": TABELLER, "formater": list(MEDIETYPER)})
+
+
+def _dato(verdi, navn):
+    try:
+        return None if verdi is None else date.fromisoformat(verdi)
+    except ValueError:
+        raise ApiFeil(400, f"Ugyldig {navn}: {verdi} (ÅÅÅÅ-MM-DD)")
+
+
+async def tabell(request):
+    tilstand = request.app.state
+    ark_type, navn = request.path_params["ark"], request.path_params["tabell"]
+    if navn not in TABELLER:
+        raise ApiFeil(404, f"Ukjent tabell {navn}, velg en av {', '.join(TABELLER)}")
+    parametre = request.query_params
+    fra, til = _dato(parametre.get("fra"), "fra"), _dato(parametre.get("til"), "til")
+    år = parametre.get("år")
+    if år is not None and not år.isdigit():
+        raise ApiFeil(400, f"Ugyldig år: {år}")
+    år = None if år is None else int(år)
+
+    datasett = await hent_datasett(tilstand, ark_type)
+    etag = lag_etag(datasett["versjon"], ark_type, navn, fra, til, år)
+    if ikke_endret(request, etag):
+        return Response(status_code=304, headers=hoder(etag))
+    innhold = await hent_svar(tilstand, etag, lambda: run_in_threadpool(
+        tabell_json, datasett, ark_type, navn, fra, til, år))
+    return Response(innhold, media_type="application/json", headers=hoder(etag))
+
+
+async def tegn(tilstand, jobb, filformat):
+    loop = asyncio.get_running_loop()
+    tegner = tilstand.tegner
+    try:
+        return await loop.run_in_executor(tegner, partial(tegn_graf_png, *jobb, filformat=filformat))
+    except BrokenProcessPool:
+        # A worker died (out of memory, a crash) and took the pool with it. The first
+        # request to notice starts a new one, and the chart is drawn again there.
+        if tilstand.tegner is tegner:
+            tilstand.tegner = lag_prosesspool(tilstand.prosesser)
+            tegner.shutdown(wait=False)
+        return await loop.run_in_executor(tilstand.tegner, partial(tegn_graf_png, *jobb, filformat=filformat))
+
+
+async def graf(request):
+    tilstand = request.app.state
+    ark_type, navn = request.path_params["ark"], request.path_params["tabell"]
+    stamme, _, filformat = request.path_params["navn"].rpartition(".")
+    if filformat not in MEDIETYPER:
+        raise ApiFeil(404, f"Ukjent format {filformat}, velg en av {', '.join(MEDIETYPER)}")
+
+    datasett = await hent_datasett(tilstand, ark_type)
+    jobb = datasett["grafer"].get(f"{navn}/{stamme}")
+    if jobb is None:
+        raise ApiFeil(404, f"Ingen graf {navn}/{stamme} for {ark_type}")
+    # The same fingerprint the batch manifest uses: it only changes with the numbers and titles
+    etag = '"' + fingeravtrykk(jobb, filformat)[:32] + '"'
+    if ikke_endret(request, etag):
+        return Response(status_code=304, headers=hoder(etag))
+    innhold = await hent_svar(tilstand, etag, lambda: tegn(tilstand, jobb, filformat))
+    return Response(innhold, media_type=MEDIETYPER[filformat], headers=hoder(etag))
+
+
+async def api_feil(request, feil):
+    return JSONResponse({"feil": str(feil)}, status_code=feil.status)
+
+
+def lag_api(arbeidsboker, prosesser=None):
+    # arbeidsboker maps a sheet type to its workbook. Charts are drawn one at a time
+    # in a worker thread (matplotlib is not thread-safe), or in a pool of prosesser.
+    @asynccontextmanager
+    async def levetid(api):
+        tilstand = api.state
+        tilstand.arbeidsboker = arbeidsboker
+        tilstand.datasett = {}
+        tilstand.feilet = {}
+        tilstand.lasing = {ark_type: asyncio.Lock() for ark_type in arbeidsboker}
+        tilstand.svar = OrderedDict()
+        tilstand.svar_bytes = 0
+        tilstand.venter = {}
+        tilstand.prosesser = prosesser
+        tilstand.tegner = lag_prosesspool(prosesser) if prosesser else ThreadPoolExecutor(max_workers=1)
+        try:
+            # Read every workbook before the first request, so a broken one stops the server
+            for ark_type in arbeidsboker:
+                await hent_datasett(tilstand, ark_type)
+            yield
+        finally:
+            tilstand.tegner.shutdown(cancel_futures=True)
+
+    return Starlette(
+        routes=[
+            Route("/", oversikt),
+            Route("/{ark}/{tabell}", tabell),
+            Route("/{ark}/{tabell}/{navn}", graf),
+        ],
+        exception_handlers={ApiFeil: api_feil},
+        lifespan=levetid,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP-API med nøkkeltall og waterfall-grafer.")
+    parser.add_argument("--slakt", type=Path, help="Input-arket for slakt (.xlsx)")
+    parser.add_argument("--filet", type=Path, help="Input-arket for filet (.xlsx)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--prosesser", type=int, help="Tegn grafer i så mange prosesser samtidig")
+    args = parser.parse_args(argv)
+
+    arbeidsboker = {ark_type: sti for ark_type, sti in [("slakt", args.slakt), ("filet", args.filet)] if sti}
+    if not arbeidsboker:
+        parser.error("oppgi minst én av --slakt og --filet")
+    uvicorn.run(lag_api(arbeidsboker, args.prosesser), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
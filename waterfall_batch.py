@@ -0,0 +1,132 @@
+# Renders every daily, weekly and monthly waterfall chart of a workbook to files,
+# without Streamlit. Charts whose numbers and titles are unchanged since the last run
+# into the same folder are skipped.
+#
+#   python waterfall_batch.py "1. InputSlakt.xlsx" --ark slakt --ut rapporter
+#   python waterfall_batch.py input-filet.xlsx --ark filet --ut rapporter --fra 2024-09-01 --til 2024-12-31 --format pdf
+#   python waterfall_batch.py "linjer/*slakt*.xlsx" --ark slakt --ut rapporter --prosesser 4
+#   python waterfall_batch.py "1. InputSlakt.xlsx" --ark slakt --ut rapporter --eksport xlsx csv
+import argparse
+import hashlib
+import json
+import sys
+from contextlib import nullcontext
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+
+import waterfall_slakt_streamlit as app
+from waterfall_eksport import FORMATER, skriv_tabeller
+from waterfall_grafer import lag_prosesspool, tegn_grafer
+from waterfall_innlesing import finn_arbeidsboker, les_arbeidsboker, linjenavn
+
+MANIFEST = ".waterfall_manifest.json"
+
+
+def finn_grafer(df, ark_type, fra=None, til=None):
+    # (relative file name without extension, tegn_graf_png arguments) for every
+    # day, production week and month that has production between fra and til
+    utvalg = df.loc[pd.Timestamp(fra) if fra else None:pd.Timestamp(til) if til else None]
+    utvalg = utvalg[utvalg['gyldig']]
+
+    grafer = []
+    for dag, row in app.kpi_tabell(utvalg).iterrows():
+        grafer.append((f"dager/{dag:%Y-%m-%d}", app.graf_jobb(row, dag.date(), "enkeltgraf", ark_type)))
+
+    uker = app.ukesnitt(df, ark_type)
+    for år, uke in utvalg[['uke_år', 'uke']].drop_duplicates().itertuples(index=False):
+        grafer.append((f"uker/{år}-U{uke:02d}", app.graf_jobb(uker.loc[(år, uke)], uke, "ukesnitt", ark_type)))
+
+    maneder = app.manedsnitt(df, ark_type)
+    for år, maned in utvalg[['år', 'måned']].drop_duplicates().itertuples(index=False):
+        tittel = f"{app.MANEDSNAVN[maned - 1]} {år}"
+        grafer.append((f"maneder/{år}-{maned:02d}",
+                       app.graf_jobb(maneder.loc[(år, maned)], tittel, "manedsnitt", ark_type)))
+    return grafer
+
+
+def fingeravtrykk(jobb, filformat):
+    return hashlib.sha256(repr((jobb, filformat)).encode("utf-8")).hexdigest()
+
+
+def lag_rapport(df, ark_type, ut_mappe, fra=None, til=None, filformat="png", pool=None):
+    # Returns (number of charts written, number skipped because they were unchanged)
+    ut_mappe = Path(ut_mappe)
+    manifest_sti = ut_mappe / MANIFEST
+    manifest = json.loads(manifest_sti.read_text()) if manifest_sti.exists() else {}
+
+    nye = []
+    hoppet_over = 0
+    for navn, jobb in finn_grafer(df, ark_type, fra, til):
+        sti = ut_mappe / f"{navn}.{filformat}"
+        avtrykk = fingeravtrykk(jobb, filformat)
+        if sti.exists() and manifest.get(sti.relative_to(ut_mappe).as_posix()) == avtrykk:
+            hoppet_over += 1
+        else:
+            nye.append((sti, jobb, avtrykk))
+
+    bilder = tegn_grafer([jobb for _, jobb, _ in nye], pool if len(nye) > 1 else None, filformat)
+    for (sti, _, avtrykk), bilde in zip(nye, bilder):
+        sti.parent.mkdir(parents=True, exist_ok=True)
+        sti.write_bytes(bilde)
+        manifest[sti.relative_to(ut_mappe).as_posix()] = avtrykk
+
+    ut_mappe.mkdir(parents=True, exist_ok=True)
+    manifest_sti.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    return len(nye), hoppet_over
+
+
+def finn_filer(fil):
+    # One workbook, or every workbook in a folder or matching a glob pattern
+    if fil.is_file():
+        return [fil]
+    return finn_arbeidsboker(fil)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lager alle waterfall-grafer for en arbeidsbok uten Streamlit.")
+    parser.add_argument("fil", type=Path, help="Input-arket (.xlsx), eller en mappe/et mønster med ett ark per linje")
+    parser.add_argument("--ark", choices=["slakt", "filet"], required=True, help="Type ark")
+    parser.add_argument("--ut", type=Path, default=Path("rapporter"), help="Mappe grafene skrives til")
+    parser.add_argument("--fra", type=date.fromisoformat, help="Første dato (ÅÅÅÅ-MM-DD)")
+    parser.add_argument("--til", type=date.fromisoformat, help="Siste dato (ÅÅÅÅ-MM-DD)")
+    parser.add_argument("--format", choices=["png", "pdf", "svg"], default="png", dest="filformat")
+    parser.add_argument("--prosesser", type=int, help="Les og tegn i så mange prosesser samtidig")
+    parser.add_argument("--eksport", nargs="+", choices=FORMATER, default=[],
+                        help="Skriv også nøkkeltallene for alle dager (dager, uker, måneder) i disse formatene")
+    args = parser.parse_args(argv)
+
+    filer = finn_filer(args.fil)
+    if not filer:
+        print(f"Feil: Finner ingen arbeidsbøker i {args.fil}", file=sys.stderr)
+        return 1
+
+    linjer, kollisjoner = linjenavn(filer)
+    for filnavn, navn in kollisjoner.items():
+        print(f"Merk: Flere arbeidsbøker heter {filnavn}, skrives til {', '.join(navn)}", file=sys.stderr)
+
+    feil = 0
+    with lag_prosesspool(args.prosesser) if args.prosesser else nullcontext() as pool:
+        # With several workbooks each line gets its own subfolder, named after the file
+        # (with its folder in front when file names repeat, see linjenavn)
+        for fil, linje, (df, melding) in zip(filer, linjer, les_arbeidsboker(filer, args.ark, pool)):
+            ut_mappe = args.ut if len(filer) == 1 else args.ut / linje
+            try:
+                if df is None:
+                    raise ValueError(f"Kunne ikke lese {fil}: {melding}")
+                dager = app.forbered_datasett(df, args.ark)
+                tegnet, hoppet_over = lag_rapport(dager, args.ark, ut_mappe, args.fra, args.til, args.filformat, pool)
+            except ValueError as e:
+                print(f"Feil: {e}", file=sys.stderr)
+                feil += 1
+                continue
+            print(f"{tegnet} grafer skrevet til {ut_mappe}, {hoppet_over} uendret")
+            for filformat in args.eksport:
+                for sti in skriv_tabeller(app.eksport_tabeller(dager, args.ark), ut_mappe / "nokkeltall", filformat):
+                    print(f"Nøkkeltall skrevet til {sti}")
+    return 1 if feil else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# Writes the KPI tables (daily numbers plus weekly and monthly averages) to CSV,
+# Parquet or xlsx, without Streamlit. tabeller is a dict of table name -> DataFrame,
+# see eksport_tabeller in waterfall_slakt_streamlit.py.
+import io
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+from waterfall_lat import lat_import
+
+pd = lat_import("pandas", globals(), "pd")
+pa = lat_import("pyarrow", globals(), "pa")
+pq = lat_import("pyarrow.parquet", globals(), "pq")
+openpyxl = lat_import("openpyxl", globals(), "openpyxl")
+openpyxl_celle = lat_import("openpyxl.cell", globals(), "openpyxl_celle")
+
+FORMATER = ["csv", "parquet", "xlsx"]
+XLSX_NAVN = "nokkeltall.xlsx"
+# Rows are converted and written this many at a time
+BLOKK = 5000
+
+
+def _xlsx_verdi(verdi):
+    # Excel has no NaN; empty cells instead
+    if verdi is None or verdi is pd.NaT or (isinstance(verdi, float) and verdi != verdi) or verdi is pd.NA:
+        return None
+    if isinstance(verdi, pd.Timestamp):
+        return verdi.to_pydatetime()
+    return verdi
+
+
+def skriv_xlsx(tabeller, fil):
+    # One sheet per table. openpyxl's write-only mode streams each row to a temporary
+    # file, so memory use does not grow with the number of rows. fil is a path or a
+    # binary file object.
+    wb = openpyxl.Workbook(write_only=True)
+    for navn, tabell in tabeller.items():
+        ws = wb.create_sheet(navn)
+        ws.append([str(kolonne) for kolonne in tabell.columns])
+        datoer = [pd.api.types.is_datetime64_any_dtype(tabell[kolonne]) for kolonne in tabell.columns]
+        for start in range(0, len(tabell), BLOKK):
+            for rad in tabell.iloc[start:start + BLOKK].itertuples(index=False, name=None):
+                celler = []
+                for verdi, dato in zip(rad, datoer):
+                    verdi = _xlsx_verdi(verdi)
+                    if dato and isinstance(verdi, datetime):
+                        celle = openpyxl_celle.WriteOnlyCell(ws, verdi)
+                        celle.number_format = "yyyy-mm-dd"
+                        celler.append(celle)
+                    else:
+                        celler.append(verdi)
+                ws.append(celler)
+    wb.save(fil)
+
+
+def skriv_parquet(tabell, fil):
+    # Written in row groups of BLOKK rows. The schema is inferred from the whole
+    # table: from no rows, an object column of text would become type null.
+    skjema = pa.Schema.from_pandas(tabell, preserve_index=False)
+    with pq.ParquetWriter(fil, skjema) as skriver:
+        for start in range(0, len(tabell), BLOKK):
+            skriver.write_table(pa.Table.from_pandas(tabell.iloc[start:start + BLOKK], schema=skjema,
+                                                     preserve_index=False))
+
+
+def skriv_csv(tabell, fil):
+    tabell.to_csv(fil, index=False, chunksize=BLOKK)
+
+
+def skriv_tabeller(tabeller, mappe, filformat):
+    # One file per table in mappe for csv/parquet, one workbook for xlsx.
+    # Returns the paths written.
+    mappe = Path(mappe)
+    mappe.mkdir(parents=True, exist_ok=True)
+    if filformat == "xlsx":
+        skriv_xlsx(tabeller, mappe / XLSX_NAVN)
+        return [mappe / XLSX_NAVN]
+    skriv = skriv_csv if filformat == "csv" else skriv_parquet
+    stier = []
+    for navn, tabell in tabeller.items():
+        stier.append(mappe / f"{navn}.{filformat}")
+        skriv(tabell, stier[-1])
+    return stier
+
+
+def eksport_bytes(tabeller, filformat):
+    # For a download: the xlsx workbook, or a zip with one csv/parquet file per table
+    buffer = io.BytesIO()
+    if filformat == "xlsx":
+        skriv_xlsx(tabeller, buffer)
+        return buffer.getvalue()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as arkiv:
+        for navn, tabell in tabeller.items():
+            with arkiv.open(f"{navn}.{filformat}", "w") as fil:
+                if filformat == "csv":
+                    tekst = io.TextIOWrapper(fil, encoding="utf-8", newline="")
+                    skriv_csv(tabell, tekst)
+                    # Flushes, and leaves closing the zip entry to the with block
+                    tekst.detach()
+                else:
+                    skriv_parquet(tabell, fil)
+    return buffer.getvalue()
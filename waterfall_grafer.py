@@ -0,0 +1,467 @@
+# Chart rendering without Streamlit, so it can run in worker processes and scripts.
+# Everything here takes plain numbers and strings and returns PNG bytes, or a
+# Vega-Lite spec for the browser to draw.
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from waterfall_lat import lat_import
+
+np = lat_import("numpy", globals(), "np")
+figur = lat_import("matplotlib.figure", globals(), "figur")
+
+
+def tegn_graf_png(annet, faktisk_takt, stopptid_takt, tittel, ylabel, ark_type, oee, stiplet, filformat="png"):
+    # Draws on a standalone Figure that is never registered with pyplot, so it is
+    # freed as soon as the PNG is written instead of piling up in pyplot's registry
+    fig = figur.Figure(figsize=(10, 5), dpi=100)
+    ax = fig.subplots()
+    stages = ['100% OEE', 'Stopptid', 'Annet']
+    values = [oee, -stopptid_takt, -annet]
+    cum_values = np.cumsum([0] + values).tolist()
+    value_starts = cum_values[:-1]
+    colors = ['blue', 'red', 'orange']
+
+
+    for i in range(len(stages)):
+        ax.bar(stages[i], values[i], bottom=value_starts[i], color=colors[i], edgecolor='black')
+
+    ax.bar('Takttid', faktisk_takt, bottom=0, color='green', edgecolor='black')
+    ax.bar('Takttid', stiplet - faktisk_takt, bottom=faktisk_takt, color='none', edgecolor='green', hatch='//')
+
+    for i in range(len(stages)):
+        if stages[i] == 'Stopptid':
+            if ark_type == "slakt":
+                if stopptid_takt < 9:
+                    # Place the text outside the bar if the value is less than 7
+                    dynamic_offset = value_starts[i] + values[i] -2  # Adjust `-10` for spacing
+                    ax.text(
+                        stages[i], dynamic_offset,
+                        f'{values[i]} ({abs(values[i]) / oee * 100:.1f}%)',
+                        ha='center', va='top', color='black', fontweight='bold'
+                        )
+                else:
+                    # Place the text inside the bar if the value is greater than or equal to 7
+                    y_pos = value_starts[i] + values[i] / 2
+                    ax.text(
+                        stages[i], y_pos,
+                        f'{values[i]} ({abs(values[i]) / oee * 100:.1f}%)',
+                        ha='center', va='center', color='black', fontweight='bold'
+                    )
+            elif ark_type == "filet":
+                if stopptid_takt < 1.5:
+                    # Place the text outside the bar if the value is less than 7
+                        dynamic_offset = value_starts[i] + values[i]-0.5 # Adjust `-10` for spacing
+                        ax.text(
+                            stages[i], dynamic_offset,
+                            f'{values[i]} ({abs(values[i]) / oee * 100:.1f}%)',
+                            ha='center', va='top', color='black', fontweight='bold'
+                        )
+                else:
+                    # Place the text inside the bar if the value is greater than or equal to 7
+                    y_pos = value_starts[i] + values[i] / 2
+                    ax.text(
+                        stages[i], y_pos,
+                        f'{values[i]} ({abs(values[i]) / oee * 100:.1f}%)',
+                        ha='center', va='center', color='black', fontweight='bold'
+                    )
+        else:
+            # Place the text inside other bars as before
+            y_pos = value_starts[i] + values[i] / 2
+            ax.text(
+                stages[i], y_pos,
+                f'{values[i]} ({abs(values[i]) / oee * 100:.1f}%)',
+                ha='center', va='center', color='black', fontweight='bold'
+            )
+
+    ax.text(
+        'Takttid', faktisk_takt / 2,
+        f'{faktisk_takt} ({(faktisk_takt / oee * 100):.1f}%)',
+        ha='center', va='center', color='black', fontweight='bold'
+    )
+
+    gap_to_80 = stiplet - faktisk_takt
+    ax.text(
+        'Takttid', stiplet + 1,
+        f'{round(gap_to_80, 2)} ({(gap_to_80 / oee * 100):.1f}%)',
+        ha='center', va='bottom', color='green', fontweight='bold'
+    )
+
+
+    ax.set_ylabel(ylabel)
+    ax.set_title(tittel)
+
+    # Same output settings st.pyplot uses
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=filformat, bbox_inches="tight", dpi=200)
+    return buffer.getvalue()
+
+
+# Detailed waterfall: the stop bar split into one step per cause. Past MAKS_ARSAKER
+# steps the smallest causes are drawn together as one.
+MAKS_ARSAKER = 8
+ANDRE_ARSAKER = "Andre stopp"
+
+
+def _arsak_steg(arsaker):
+    # arsaker is a tuple of (cause, stop takt), largest first
+    if len(arsaker) <= MAKS_ARSAKER:
+        return list(arsaker)
+    resten = round(sum(verdi for _, verdi in arsaker[MAKS_ARSAKER - 1:]), 2)
+    return list(arsaker[:MAKS_ARSAKER - 1]) + [(ANDRE_ARSAKER, resten)]
+
+
+def _detaljert_steg(arsaker, annet, oee):
+    # (name, value, bottom, colour) of every waterfall step
+    steg = [('100% OEE', oee, 0, 'blue')]
+    niva = oee
+    for navn, verdi in _arsak_steg(arsaker):
+        steg.append((navn, -verdi, niva, 'red'))
+        niva -= verdi
+    steg.append(('Annet', -annet, niva, 'orange'))
+    return steg
+
+
+def tegn_detaljert_graf_png(arsaker, annet, faktisk_takt, stopptid_takt, tittel, ylabel, ark_type, oee, stiplet,
+                            filformat="png"):
+    # tegn_graf_png with the stop bar split into its causes
+    fig = figur.Figure(figsize=(12, 5), dpi=100)
+    ax = fig.subplots()
+    steg = _detaljert_steg(arsaker, annet, oee)
+    ax.bar([s[0] for s in steg], [s[1] for s in steg], bottom=[s[2] for s in steg],
+           color=[s[3] for s in steg], edgecolor='black')
+    ax.bar('Takttid', faktisk_takt, bottom=0, color='green', edgecolor='black')
+    ax.bar('Takttid', stiplet - faktisk_takt, bottom=faktisk_takt, color='none', edgecolor='green', hatch='//')
+
+    for x, (_, verdi, bunn, _) in enumerate(steg):
+        if abs(verdi) < oee * 0.06:
+            # Too thin for the text, which goes under the bar instead
+            ax.text(x, bunn + verdi - oee * 0.01, f'{round(verdi, 2)}', ha='center', va='top', fontsize=8,
+                    fontweight='bold')
+        else:
+            # Value and share on two lines to fit the narrower bars
+            ax.text(x, bunn + verdi / 2, f'{round(verdi, 2)}\n({abs(verdi) / oee * 100:.1f}%)', ha='center',
+                    va='center', fontsize=8, fontweight='bold')
+    ax.text('Takttid', faktisk_takt / 2, f'{faktisk_takt}\n({(faktisk_takt / oee * 100):.1f}%)',
+            ha='center', va='center', fontsize=8, fontweight='bold')
+    gap_to_80 = stiplet - faktisk_takt
+    ax.text('Takttid', stiplet + 1, f'{round(gap_to_80, 2)} ({(gap_to_80 / oee * 100):.1f}%)',
+            ha='center', va='bottom', color='green', fontweight='bold')
+
+    for etikett in ax.get_xticklabels():
+        etikett.set_rotation(30)
+        etikett.set_horizontalalignment('right')
+    ax.set_ylabel(ylabel)
+    ax.set_title(f'{tittel}\nStopptid {round(stopptid_takt, 2)} fordelt på årsaker')
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=filformat, bbox_inches="tight", dpi=200)
+    return buffer.getvalue()
+
+
+def tegn_pareto_png(arsaker, tittel, ylabel, filformat="png"):
+    # Stop takt per cause, largest first, with the cumulative share of the stop time
+    fig = figur.Figure(figsize=(12, 5), dpi=100)
+    ax = fig.subplots()
+    navn = [n for n, _ in arsaker]
+    verdier = np.array([v for _, v in arsaker])
+    ax.bar(navn, verdier, color='red', edgecolor='black')
+    for x, verdi in enumerate(verdier):
+        ax.text(x, verdi, f'{verdi:g}', ha='center', va='bottom', fontsize=8, fontweight='bold')
+
+    kumulativ = np.cumsum(verdier) / verdier.sum() * 100
+    ax2 = ax.twinx()
+    ax2.plot(navn, kumulativ, color='black', marker='o')
+    ax2.axhline(80, color='grey', linestyle='--', linewidth=1)
+    ax2.set_ylim(0, 105)
+    ax2.set_ylabel('Kumulativ andel av stopptid (%)')
+
+    for etikett in ax.get_xticklabels():
+        etikett.set_rotation(30)
+        etikett.set_horizontalalignment('right')
+    ax.set_ylabel(ylabel)
+    ax.set_title(tittel)
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=filformat, bbox_inches="tight", dpi=200)
+    return buffer.getvalue()
+
+
+def tegn_scenarier_png(scenarier, tittel, ylabel, filformat="png"):
+    # One stacked bar per scenario, from the bottom: actual takt, annet and stop takt,
+    # up to the scenario's capacity, with its target as a dashed line. scenarier is a
+    # tuple of (name, stopptid_takt, annet, faktisk_takt, capacity, target).
+    fig = figur.Figure(figsize=(max(8, 0.7 * len(scenarier) + 3), 5), dpi=100)
+    ax = fig.subplots()
+    x = np.arange(len(scenarier))
+    navn = [s[0] for s in scenarier]
+    stopptid_takt, annet, faktisk_takt, _, mal = (np.array([s[i] for s in scenarier]) for i in range(1, 6))
+    ax.bar(x, faktisk_takt, color='green', edgecolor='black', label='Faktisk takt')
+    ax.bar(x, annet, bottom=faktisk_takt, color='orange', edgecolor='black', label='Annet')
+    ax.bar(x, stopptid_takt, bottom=faktisk_takt + annet, color='red', edgecolor='black', label='Stopptid')
+    ax.hlines(mal, x - 0.45, x + 0.45, color='black', linestyles='--', label='Mål')
+    if len(scenarier) <= 20:
+        for i in x:
+            ax.text(i, faktisk_takt[i] / 2, f'{faktisk_takt[i]:g}', ha='center', va='center', fontsize=8,
+                    fontweight='bold')
+
+    ax.set_xticks(x, navn)
+    for etikett in ax.get_xticklabels():
+        etikett.set_rotation(30)
+        etikett.set_horizontalalignment('right')
+    ax.legend(loc='upper left', bbox_to_anchor=(1, 1))
+    ax.set_ylabel(ylabel)
+    ax.set_title(tittel)
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=filformat, bbox_inches="tight", dpi=200)
+    return buffer.getvalue()
+
+
+def tegn_maned_oversikt_png(dager, tittel, ark_type, oee, stiplet):
+    # All daily waterfalls of a month as small multiples in one figure.
+    # dager is a tuple of (label, stopptid_takt, faktisk_takt, annet).
+    antall = len(dager)
+    kolonner = min(5, antall)
+    rader = -(-antall // kolonner)
+    fig = figur.Figure(figsize=(3.2 * kolonner, 2.6 * rader + 0.6), dpi=100, layout="constrained")
+    akser = fig.subplots(rader, kolonner, sharey=True, squeeze=False).ravel()
+
+    stages = ['OEE', 'Stopp', 'Annet', 'Takt']
+    colors = ['blue', 'red', 'orange', 'green']
+    for ax, (etikett, stopptid_takt, faktisk_takt, annet) in zip(akser, dager):
+        # One bar call per day: the waterfall steps and the takt bar side by side
+        values = np.array([oee, -stopptid_takt, -annet, faktisk_takt])
+        value_starts = np.array([0, oee, oee - stopptid_takt, 0])
+        ax.bar(stages, values, bottom=value_starts, color=colors, edgecolor='black')
+        ax.axhline(stiplet, color='green', linestyle='--', linewidth=1)
+        for x, (verdi, bunn) in enumerate(zip(values, value_starts)):
+            ax.text(x, bunn + verdi / 2, f'{verdi:g}', ha='center', va='center', fontsize=7, fontweight='bold')
+        ax.set_title(etikett, fontsize=9)
+        ax.tick_params(labelsize=7)
+
+    # Shared y axis, with some headroom above the OEE bar for the labels
+    akser[0].set_ylim(0, max(oee, stiplet) * 1.1)
+    for ax in akser[antall:]:
+        ax.set_visible(False)
+    fig.suptitle(tittel)
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=100)
+    return buffer.getvalue()
+
+
+# Vega-Lite versions of the two charts above, drawn in the browser. Only the KPI
+# numbers go over the wire, and every bar has a tooltip.
+GRAF_STEG = ['100% OEE', 'Stopptid', 'Annet', 'Takttid']
+# Below these stop takt values the label goes under the bar, as in tegn_graf_png
+SMAL_STOPPTID = {"slakt": (9, 2), "filet": (1.5, 0.5)}
+
+
+def _graf_rader(annet, faktisk_takt, stopptid_takt, ark_type, oee, stiplet, steg=GRAF_STEG):
+    # One row per bar: the waterfall steps, the takt bar and the gap up to the target
+    rader = []
+    for navn, verdi, bunn, farge in [
+        (steg[0], oee, 0, "blue"),
+        (steg[1], -stopptid_takt, oee, "red"),
+        (steg[2], -annet, oee - stopptid_takt, "orange"),
+        (steg[3], faktisk_takt, 0, "green"),
+    ]:
+        rader.append({
+            "steg": navn, "del": "søyle", "fra": bunn, "til": bunn + verdi, "verdi": verdi,
+            "andel": abs(verdi) / oee, "farge": farge, "tekst_y": bunn + verdi / 2,
+            "etikett": f'{verdi} ({abs(verdi) / oee * 100:.1f}%)',
+        })
+    grense, avstand = SMAL_STOPPTID.get(ark_type, (0, 0))
+    if stopptid_takt < grense:
+        rader[1]["tekst_y"] = oee - stopptid_takt - avstand
+
+    gap = stiplet - faktisk_takt
+    rader.append({
+        "steg": steg[3], "del": "mål", "fra": faktisk_takt, "til": stiplet, "verdi": round(gap, 2),
+        "andel": gap / oee, "farge": "green", "tekst_y": stiplet + oee * 0.03,
+        "etikett": f'{round(gap, 2)} ({(gap / oee * 100):.1f}%)',
+    })
+    return rader
+
+
+def _graf_lag(ylabel, skrift=11):
+    # The bar, target and label layers shared by both specs
+    tooltip = [
+        {"field": "steg", "title": "Steg"},
+        {"field": "verdi", "title": "Per minutt", "format": ".2f"},
+        {"field": "andel", "title": "Andel av 100% OEE", "format": ".1%"},
+    ]
+    y = {"field": "fra", "type": "quantitative", "title": ylabel}
+    lag = [
+        {"transform": [{"filter": "datum.del == 'søyle'"}],
+         "mark": {"type": "bar", "stroke": "black"},
+         "encoding": {"y": y, "y2": {"field": "til"}, "color": {"field": "farge", "type": "nominal", "scale": None},
+                      "tooltip": tooltip}},
+        {"transform": [{"filter": "datum.del == 'mål'"}],
+         "mark": {"type": "bar", "fill": "green", "fillOpacity": 0.1, "stroke": "green", "strokeDash": [4, 3]},
+         "encoding": {"y": y, "y2": {"field": "til"},
+                      "tooltip": [{"field": "verdi", "title": "Opp til 80% OEE", "format": ".2f"}]}},
+        {"mark": {"type": "text", "fontWeight": "bold", "fontSize": skrift},
+         "encoding": {"y": {"field": "tekst_y", "type": "quantitative"}, "text": {"field": "etikett"},
+                      "color": {"condition": {"test": "datum.del == 'mål'", "value": "green"}, "value": "black"}}},
+    ]
+    return lag
+
+
+def lag_graf_spec(annet, faktisk_takt, stopptid_takt, tittel, ylabel, ark_type, oee, stiplet):
+    # Same arguments as tegn_graf_png
+    return {
+        "title": tittel,
+        "height": 400,
+        "data": {"values": _graf_rader(annet, faktisk_takt, stopptid_takt, ark_type, oee, stiplet)},
+        "encoding": {"x": {"field": "steg", "type": "nominal", "sort": GRAF_STEG, "title": None,
+                           "axis": {"labelAngle": 0}}},
+        "layer": _graf_lag(ylabel),
+    }
+
+
+def lag_maned_oversikt_spec(dager, tittel, ark_type, oee, stiplet):
+    # Same arguments as tegn_maned_oversikt_png; one small chart per day, five per row
+    steg = ['OEE', 'Stopp', 'Annet', 'Takt']
+    rader = []
+    for etikett, stopptid_takt, faktisk_takt, annet in dager:
+        for rad in _graf_rader(annet, faktisk_takt, stopptid_takt, ark_type, oee, stiplet, steg):
+            # Short labels in the middle of the bars, none on the gap to the target
+            rad["dag"] = etikett
+            rad["tekst_y"] = (rad["fra"] + rad["til"]) / 2
+            rad["etikett"] = f'{rad["verdi"]:g}' if rad["del"] == "søyle" else ""
+            rader.append(rad)
+    return {
+        "title": tittel,
+        "data": {"values": rader},
+        "facet": {"field": "dag", "type": "ordinal", "sort": None, "title": None},
+        "columns": 5,
+        "spec": {
+            "width": 160, "height": 130,
+            "encoding": {"x": {"field": "steg", "type": "nominal", "sort": steg, "title": None,
+                               "axis": {"labelAngle": 0}}},
+            "layer": _graf_lag(None, skrift=8),
+        },
+        "resolve": {"scale": {"y": "shared"}},
+    }
+
+
+def lag_detaljert_graf_spec(arsaker, annet, faktisk_takt, stopptid_takt, tittel, ylabel, ark_type, oee, stiplet):
+    # Same arguments as tegn_detaljert_graf_png
+    rader = []
+    for navn, verdi, bunn, farge in _detaljert_steg(arsaker, annet, oee) + [('Takttid', faktisk_takt, 0, 'green')]:
+        rader.append({
+            "steg": navn, "del": "søyle", "fra": bunn, "til": bunn + verdi, "verdi": verdi,
+            "andel": abs(verdi) / oee, "farge": farge, "tekst_y": bunn + verdi / 2,
+            "etikett": f'{round(verdi, 2)}',
+        })
+    gap = stiplet - faktisk_takt
+    rader.append({
+        "steg": 'Takttid', "del": "mål", "fra": faktisk_takt, "til": stiplet, "verdi": round(gap, 2),
+        "andel": gap / oee, "farge": "green", "tekst_y": stiplet + oee * 0.03,
+        "etikett": f'{round(gap, 2)} ({(gap / oee * 100):.1f}%)',
+    })
+    return {
+        "title": {"text": tittel, "subtitle": f'Stopptid {round(stopptid_takt, 2)} fordelt på årsaker'},
+        "height": 400,
+        "data": {"values": rader},
+        "encoding": {"x": {"field": "steg", "type": "nominal", "sort": None, "title": None,
+                           "axis": {"labelAngle": -30}}},
+        "layer": _graf_lag(ylabel, skrift=9),
+    }
+
+
+def lag_pareto_spec(arsaker, tittel, ylabel):
+    # Same arguments as tegn_pareto_png
+    total = sum(verdi for _, verdi in arsaker)
+    rader, kumulativ = [], 0
+    for navn, verdi in arsaker:
+        kumulativ += verdi
+        rader.append({"steg": navn, "verdi": verdi, "kumulativ": kumulativ / total})
+    x = {"field": "steg", "type": "nominal", "sort": None, "title": None, "axis": {"labelAngle": -30}}
+    tooltip = [
+        {"field": "steg", "title": "Årsak"},
+        {"field": "verdi", "title": "Per minutt", "format": ".2f"},
+        {"field": "kumulativ", "title": "Kumulativ andel", "format": ".1%"},
+    ]
+    return {
+        "title": tittel,
+        "height": 400,
+        "data": {"values": rader},
+        "encoding": {"x": x, "tooltip": tooltip},
+        "layer": [
+            {"mark": {"type": "bar", "color": "red", "stroke": "black"},
+             "encoding": {"y": {"field": "verdi", "type": "quantitative", "title": ylabel}}},
+            {"mark": {"type": "line", "color": "black", "point": {"color": "black"}},
+             "encoding": {"y": {"field": "kumulativ", "type": "quantitative", "title": "Kumulativ andel av stopptid",
+                                "axis": {"format": "%"}, "scale": {"domain": [0, 1.05]}}}},
+            {"mark": {"type": "rule", "color": "grey", "strokeDash": [4, 3]},
+             "encoding": {"y": {"datum": 0.8, "type": "quantitative"}}},
+        ],
+        "resolve": {"scale": {"y": "independent"}},
+    }
+
+
+def lag_scenarier_spec(scenarier, tittel, ylabel):
+    # Same arguments as tegn_scenarier_png
+    rader = []
+    for navn, stopptid_takt, annet, faktisk_takt, kapasitet, mal in scenarier:
+        for rekkefolge, (del_, verdi, farge) in enumerate(
+                [("Faktisk takt", faktisk_takt, "green"), ("Annet", annet, "orange"), ("Stopptid", stopptid_takt, "red")]):
+            rader.append({"scenario": navn, "del": del_, "verdi": verdi, "farge": farge, "rekkefolge": rekkefolge,
+                          "kapasitet": kapasitet, "mål": mal})
+    x = {"field": "scenario", "type": "nominal", "sort": None, "title": None, "axis": {"labelAngle": -30}}
+    return {
+        "title": tittel,
+        "height": 400,
+        "data": {"values": rader},
+        "encoding": {"x": x},
+        "layer": [
+            {"mark": {"type": "bar", "stroke": "black"},
+             "encoding": {"y": {"field": "verdi", "type": "quantitative", "stack": "zero", "title": ylabel},
+                          "color": {"field": "farge", "type": "nominal", "scale": None},
+                          "order": {"field": "rekkefolge"},
+                          "tooltip": [{"field": "scenario", "title": "Scenario"}, {"field": "del", "title": "Del"},
+                                      {"field": "verdi", "title": "Per minutt", "format": ".2f"},
+                                      {"field": "kapasitet", "title": "Kapasitet"}]}},
+            {"transform": [{"filter": "datum.rekkefolge == 0"}],
+             "mark": {"type": "tick", "color": "black", "thickness": 2, "strokeDash": [4, 3]},
+             "encoding": {"y": {"field": "mål", "type": "quantitative"},
+                          "tooltip": [{"field": "mål", "title": "Mål"}]}},
+        ],
+    }
+
+
+# Chart jobs are the tegn_graf_png arguments, or the name of another chart followed
+# by its arguments
+TEGNERE = {"detaljert": tegn_detaljert_graf_png, "pareto": tegn_pareto_png, "scenarier": tegn_scenarier_png}
+SPESIFIKASJONER = {"detaljert": lag_detaljert_graf_spec, "pareto": lag_pareto_spec, "scenarier": lag_scenarier_spec}
+
+
+def tegn_jobb(jobb, filformat="png"):
+    if isinstance(jobb[0], str):
+        return TEGNERE[jobb[0]](*jobb[1:], filformat=filformat)
+    return tegn_graf_png(*jobb, filformat=filformat)
+
+
+def graf_spec(jobb):
+    if isinstance(jobb[0], str):
+        return SPESIFIKASJONER[jobb[0]](*jobb[1:])
+    return lag_graf_spec(*jobb)
+
+
+def _tegn_graf_jobb(jobb, filformat):
+    return tegn_jobb(jobb, filformat)
+
+
+def lag_prosesspool(prosesser=None):
+    # "spawn" so workers never inherit locks or threads from the Streamlit server
+    return ProcessPoolExecutor(max_workers=prosesser, mp_context=multiprocessing.get_context("spawn"))
+
+
+def tegn_grafer(jobber, pool=None, filformat="png"):
+    # jobber is a list of chart jobs (see TEGNERE); the images come back in the same order
+    if pool is None:
+        return [tegn_jobb(jobb, filformat) for jobb in jobber]
+    return list(pool.map(_tegn_graf_jobb, jobber, [filformat] * len(jobber)))
@@ -0,0 +1,384 @@
+# Workbook reading without Streamlit, so whole folders of workbooks can be read in
+# worker processes. Errors are raised or returned, never shown.
+import glob
+import io
+import operator
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+from waterfall_lat import lat_import
+from waterfall_maling import maal
+
+np = lat_import("numpy", globals(), "np")
+pd = lat_import("pandas", globals(), "pd")
+openpyxl = lat_import("openpyxl", globals(), "openpyxl")
+
+NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+COMMENTS_REL_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/comments"
+
+# The columns the app uses per sheet type, found by their header text, so a moved
+# column is still found and a missing one gives a clear error. Stop columns are summed
+# per block with the block's weight: the six Bader columns on slakt count 1/6 each.
+SKJEMA = {
+    "slakt": {
+        "dato": "Dato",
+        "start": "Tidspunkt første kasse på grader:",
+        "slutt": "Tidspunkt siste kasse på reworks stasjon:",
+        "antall_fisk": "Antall fisk pakket [antall fisk]",
+        "stopp": [
+            (1.0, [
+                "Stopp på linjen > 10 minutter pga planlagt vedlikehold [minutter]",
+                "Vente på fisk > 10 minutter fra mottaksrom [minutter]",
+                "Stopp i mottaksrom > 10 minutter [minutter]",
+                "Alle maskiner: Sum alle omstillinger [minutter]",
+            ]),
+            (1 / 6, [f"Bader {n}: Uforutsett stopp > 10 minutter [minutter]" for n in range(1, 7)]),
+            (1.0, [
+                "Manuell bord: Uforutsett stopp > 10 minutter [minutter]",
+                "Speedfeeder: Uforutsett stopp > 10 minutter [minutter]",
+                "Grader: Uforutsett stopp > 10 minutter [minutter]",
+                "Linje A: Uforutsett stopp > 10 minutter [minutter]",
+                "Linje B: Uforutsett stopp > 10 minutter [minutter]",
+                "Linje C: Uforutsett stopp > 10 minutter [minutter]",
+                "Ølve linje A: Uforutsett stopp > 10 minutter [minutter]",
+                "Ølve linje B: Uforutsett stopp > 10 minutter [minutter]",
+                "Ølve linje C: Uforutsett stopp > 10 minutter [minutter]",
+                "Manuell pakking (rework): Uforutsett stopp > 10 minutter",
+                "Utstyrsfeil: Uforutsett stopp > 10 minutter",
+            ]),
+        ],
+    },
+    "filet": {
+        "dato": "Dato",
+        "start": "Tidspunkt første kasse på sjekkvekt",
+        "slutt": "Tidspunkt siste kasse på sjekkvekt",
+        "antall_fisk": "Antall fisk pakket på linjen [antall]",
+        "stopp": [
+            (1.0, [
+                "Hodekapper 1: Uforutsett stopp > 10 minutter [minutter]",
+                "Hodekapper 2: Uforutsett stopp > 10 minutter [minutter]",
+                "Fileteringsmaskin 581 Pro Uforutsett stopp > 10 minutter [minutter]",
+                "Filetvender 1 Uforutsett stopp > 10 minutter [minutter]",
+                "Filetvender 2 Uforutsett stopp > 10 minutter [minutter]",
+                "Fileteringsmaskin 581 Uforutsett stopp > 10 minutter [minutter]",
+                "Trimmerobot 988 - Linje 1 Uforutsett stopp > 10 minutter [minutter]",
+                "Trimmerobot 988 - Linje 2 Uforutsett stopp > 10 minutter [minutter]",
+                "skinnemaskine - Linje 1 Uforutsett stopp > 10 minutter [minutter]",
+                "Filetinspektor - Linje 1 Uforutsett stopp > 10 minutter [minutter]",
+                "Automatisk filet grader - Linje 1 Uforutsett stopp > 10 minutter [minutter]",
+                "Pakking L1",
+                "Pakking L2",
+                "Venter på fisk til HK L1",
+                "IKKE I BRUK FRA 13.03.2019 Trimmerobot 200: Uforutsett stopp > 10 minutter [minutter]",
+                "IKKE I BRUK FRA 13.03.2019 Fileteringmaskin 201: Uforutsett stopp > 10 minutter [minutter]",
+                "IKKE I BRUK FRA 13.03.2019 Trimmerobot 201 Uforutsett stopp > 10 minutter [minutter]",
+                "Venter på fisk til HK L2",
+                "Utstyrsfeil (som f.eks. bånd, hodekapper / HK etc.) Uforutsett stopp > 10 minutter [minutter]",
+                "Alle maskiner på linjen Omstillinger uavhengig av varighet [minutter]",
+            ]),
+        ],
+    },
+}
+# Chart names of the stop columns where dropping the standard suffix is not enough
+KORTE_ARSAKSNAVN = {
+    "Stopp på linjen > 10 minutter pga planlagt vedlikehold [minutter]": "Planlagt vedlikehold",
+    "Vente på fisk > 10 minutter fra mottaksrom [minutter]": "Venter på fisk fra mottaksrom",
+    "Stopp i mottaksrom > 10 minutter [minutter]": "Stopp i mottaksrom",
+    "Alle maskiner: Sum alle omstillinger [minutter]": "Omstillinger",
+    "Utstyrsfeil (som f.eks. bånd, hodekapper / HK etc.) Uforutsett stopp > 10 minutter [minutter]": "Utstyrsfeil",
+    "Alle maskiner på linjen Omstillinger uavhengig av varighet [minutter]": "Omstillinger",
+}
+MAKS_OVERSKRIFTSRAD = 5
+
+TIDSFORMATER = ["%H:%M:%S"]
+ALTERNATIVE_SLUTTFORMATER = ["%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%d-%m-%Y %H:%M:%S"]
+# strptime puts bare times on 1900-01-01, all times are measured from there
+NULLPUNKT = datetime(1900, 1, 1)
+
+
+def hent_filbytes(uploaded_file):
+    # Works for Streamlit's UploadedFile, open file objects, raw bytes and plain paths
+    if isinstance(uploaded_file, bytes):
+        return uploaded_file
+    if hasattr(uploaded_file, "getvalue"):
+        return uploaded_file.getvalue()
+    if hasattr(uploaded_file, "read"):
+        uploaded_file.seek(0)
+        return uploaded_file.read()
+    with open(uploaded_file, "rb") as f:
+        return f.read()
+
+
+def _rel_target(base_path, target):
+    # Resolve a relationship target relative to the part that owns it
+    if target.startswith("/"):
+        return target.lstrip("/")
+    parts = base_path.split("/")[:-1]
+    for piece in target.split("/"):
+        if piece == "..":
+            parts.pop()
+        elif piece and piece != ".":
+            parts.append(piece)
+    return "/".join(parts)
+
+
+def _les_relasjoner(arkiv, part_path):
+    mappe, navn = part_path.rsplit("/", 1) if "/" in part_path else ("", part_path)
+    rels_path = f"{mappe}/_rels/{navn}.rels" if mappe else f"_rels/{navn}.rels"
+    if rels_path not in arkiv.namelist():
+        return []
+    root = ET.fromstring(arkiv.read(rels_path))
+    return [(rel.get("Id"), rel.get("Type"), _rel_target(part_path, rel.get("Target")))
+            for rel in root.iter(f"{NS_PKG_REL}Relationship")]
+
+
+def finn_kommentar_del(arkiv):
+    # Find the comments part belonging to the first sheet (the one pd.read_excel reads)
+    workbook = ET.fromstring(arkiv.read("xl/workbook.xml"))
+    first_sheet = next(workbook.iter(f"{NS_MAIN}sheet"))
+    sheet_rid = first_sheet.get(f"{NS_REL}id")
+    sheet_path = next(target for rid, _, target in _les_relasjoner(arkiv, "xl/workbook.xml") if rid == sheet_rid)
+    for _, rel_type, target in _les_relasjoner(arkiv, sheet_path):
+        if rel_type == COMMENTS_REL_TYPE:
+            return target
+    return None
+
+
+def kommentar_til_hh_mm(comment_text):
+    # Keep the digits written after the third colon in the comment
+    colon_count = 0
+    hh_mm = ""
+    for char in comment_text:
+        if char == ":":
+            colon_count += 1
+        if colon_count >= 3 and char.isdigit():
+            hh_mm += char
+    return hh_mm.strip() if hh_mm else ""
+
+
+def les_kommentarer_kolonne_d(arkiv, comments_path):
+    # Stream the comments part and keep only column D, without building openpyxl's comment objects
+    kommentarer = {}
+    if comments_path is None or comments_path not in arkiv.namelist():
+        return kommentarer
+    with arkiv.open(comments_path) as f:
+        for _, elem in ET.iterparse(f, events=("end",)):
+            if elem.tag != f"{NS_MAIN}comment":
+                continue
+            ref = elem.get("ref", "")
+            kolonne = ref.rstrip("0123456789")
+            if kolonne == "D":
+                text = elem.find(f"{NS_MAIN}text")
+                snippets = []
+                if text is not None:
+                    plain = text.find(f"{NS_MAIN}t")
+                    if plain is not None and plain.text:
+                        snippets.append(plain.text)
+                    for run in text.findall(f"{NS_MAIN}r/{NS_MAIN}t"):
+                        if run.text:
+                            snippets.append(run.text)
+                kommentarer[int(ref[len(kolonne):])] = kommentar_til_hh_mm("".join(snippets))
+            elem.clear()
+    return kommentarer
+
+
+def normaliser_overskrift(tekst):
+    # Headers are compared without case, line breaks and repeated spaces
+    return " ".join(str(tekst).split()).lower() if tekst is not None else ""
+
+
+def finn_kolonner(rader, ark_type):
+    # Finds the header row (the first row with "Dato" in column A) among the first
+    # rows and the position of every column in SKJEMA. Returns (header row number,
+    # {column name: position}); raises ValueError naming the columns that are missing.
+    skjema = SKJEMA[ark_type]
+    for rad_nr, rad in enumerate(rader, start=1):
+        if rad_nr > MAKS_OVERSKRIFTSRAD:
+            break
+        if not rad or normaliser_overskrift(rad[0]) != normaliser_overskrift(skjema["dato"]):
+            continue
+        posisjoner = {}
+        for i, tekst in enumerate(rad):
+            posisjoner.setdefault(normaliser_overskrift(tekst), i)
+        mangler = [navn for navn in skjema_kolonner(ark_type) if normaliser_overskrift(navn) not in posisjoner]
+        if mangler:
+            raise ValueError(
+                f"Arket ser ikke ut som et input-{ark_type}-ark. Fant ikke disse kolonnene i "
+                f"overskriftsraden (rad {rad_nr}): " + "; ".join(f"'{navn}'" for navn in mangler))
+        return rad_nr, {navn: posisjoner[normaliser_overskrift(navn)] for navn in skjema_kolonner(ark_type)}
+    raise ValueError(f"Fant ingen overskriftsrad med '{skjema['dato']}' i kolonne A "
+                     f"blant de {MAKS_OVERSKRIFTSRAD} første radene.")
+
+
+def skjema_kolonner(ark_type):
+    skjema = SKJEMA[ark_type]
+    return [skjema["dato"], skjema["start"], skjema["slutt"], skjema["antall_fisk"]] + stoppkolonner(ark_type)
+
+
+def stoppkolonner(ark_type):
+    return [kolonne for _, kolonner in SKJEMA[ark_type]["stopp"] for kolonne in kolonner]
+
+
+def stoppvekter(ark_type):
+    # The weight of every stop column, in stoppkolonner order
+    return np.array([vekt for vekt, kolonner in SKJEMA[ark_type]["stopp"] for _ in kolonner])
+
+
+def arsaknavn(ark_type):
+    # Short names of the stop causes for charts, in stoppkolonner order
+    navn = []
+    for kolonne in stoppkolonner(ark_type):
+        kort = KORTE_ARSAKSNAVN.get(kolonne)
+        if kort is None:
+            kort = re.sub(r"\s*\[minutter\]$", "", kolonne)
+            kort = re.sub(r"[:\s]*Uforutsett stopp > 10 minutter$", "", kort)
+            kort = re.sub(r"^IKKE I BRUK FRA \S+\s*", "", kort)
+        navn.append(kort)
+    return navn
+
+
+def _tid_fra_tekst(tekst, formater):
+    # First format that matches wins, as timedelta since NULLPUNKT (NaT if none match)
+    tidspunkt = pd.Series(pd.NaT, index=tekst.index, dtype="datetime64[ns]")
+    for fmt in formater:
+        mangler = tidspunkt.isna() & tekst.notna()
+        if not mangler.any():
+            break
+        tidspunkt[mangler] = pd.to_datetime(tekst[mangler], format=fmt, errors="coerce")
+    return tidspunkt - NULLPUNKT
+
+
+def _som_tekst(verdier):
+    # The cell values as the text pandas used to give them; empty cells are "nan"
+    return pd.Series(["nan" if v is None or v == "" else str(v) for v in verdier], dtype=object)
+
+
+def _som_antall(verdier):
+    antall = pd.to_numeric(pd.Series(verdier, dtype=object), errors="coerce")
+    if (antall.dropna() % 1 == 0).all() and antall.abs().max(skipna=True) < 2**31:
+        return antall.astype("Int32")
+    return antall.astype(float)
+
+
+def lag_tabell(rader, kolonner, ark_type):
+    # rader hold only the SKJEMA columns, at the positions in kolonner. Compact types:
+    # dates, start/end as timedelta since midnight plus the cell text (for messages),
+    # counts as Int32 and stop minutes as float32. Text in a stop column cannot be
+    # summed; those rows get stopp_tekst.
+    skjema = SKJEMA[ark_type]
+    tabell = np.empty((len(rader), max(kolonner.values()) + 1), dtype=object)
+    if rader:
+        tabell[:] = rader
+
+    def kolonne(navn):
+        return tabell[:, kolonner[navn]]
+
+    # Timestamps when the column holds only dates; anything else is left for
+    # normaliser_datoer to reject
+    data = {"Dato": pd.Series(kolonne(skjema["dato"]), dtype=object).infer_objects()}
+    for navn, formater in (("start", TIDSFORMATER), ("slutt", TIDSFORMATER + ALTERNATIVE_SLUTTFORMATER)):
+        tekst = _som_tekst(kolonne(skjema[navn]))
+        data[navn] = _tid_fra_tekst(tekst, formater)
+        data[f"{navn}_tekst"] = tekst
+    data["antall_fisk"] = _som_antall(kolonne(skjema["antall_fisk"]))
+
+    # All stop columns are converted in one go
+    navn = stoppkolonner(ark_type)
+    blokk = tabell[:, [kolonner[kolonne] for kolonne in navn]]
+    tall = pd.to_numeric(pd.Series(blokk.ravel(), dtype=object), errors="coerce").to_numpy(dtype=float)
+    tall = tall.reshape(blokk.shape)
+    for i, kolonne in enumerate(navn):
+        data[kolonne] = tall[:, i].astype(np.float32)
+    data["stopp_tekst"] = (np.isnan(tall) & pd.notna(blokk)).any(axis=1)
+    return pd.DataFrame(data)
+
+
+def les_arbeidsbok(data, ark_type):
+    # Read the archive once; openpyxl streams the cell values in read-only mode and
+    # only the SKJEMA columns are kept. The comments part is parsed separately for "slakt".
+    with maal("read_excel"):
+        workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True, keep_links=False)
+        try:
+            rader = workbook.worksheets[0].iter_rows(values_only=True)
+            overskriftsrad, kolonner = finn_kolonner(rader, ark_type)
+            # Each row is cut down to the SKJEMA columns as it is streamed, so only
+            # those are kept; kolonner then points into the shorter rows
+            indekser = sorted(kolonner.values())
+            bredde = indekser[-1] + 1
+            velg = operator.itemgetter(*indekser)
+            rader = [velg(rad if len(rad) >= bredde else rad + (None,) * (bredde - len(rad))) for rad in rader]
+            kolonner = {navn: indekser.index(i) for navn, i in kolonner.items()}
+        finally:
+            workbook.close()
+        # Empty rows at the end of the sheet are dropped, like pd.read_excel does
+        while rader and all(verdi is None for verdi in rader[-1]):
+            rader.pop()
+        df = lag_tabell(rader, kolonner, ark_type)
+
+    if ark_type == "slakt":
+        with maal("kommentarer"), zipfile.ZipFile(io.BytesIO(data)) as arkiv:
+            kommentarer = les_kommentarer_kolonne_d(arkiv, finn_kommentar_del(arkiv))
+
+        # The data starts on the row after the header
+        df["comments"] = [kommentarer.get(overskriftsrad + 1 + i, "") for i in range(len(df))]
+
+    return df
+
+
+def finn_arbeidsboker(mappe_eller_monster):
+    # All .xlsx files in a folder, or the files matching a glob pattern, sorted.
+    # Excel's "~$" lock files are skipped.
+    sti = Path(mappe_eller_monster)
+    if sti.is_dir():
+        filer = sti.glob("*.xlsx")
+    else:
+        filer = map(Path, glob.glob(str(mappe_eller_monster), recursive=True))
+    return sorted(f for f in filer if f.is_file() and not f.name.startswith("~$"))
+
+
+def linjenavn(filer):
+    # One unique line name per workbook (path or file name), in the same order: the
+    # file name without extension. Workbooks with the same file name, as when every
+    # site uploads its input-slakt.xlsx, get their folder in front ("linje1/input-slakt"),
+    # and a counter ("input-slakt (2)") when that does not tell them apart either.
+    # Returns (names, {shared file name: the names given}) so the collisions can be shown.
+    filer = [Path(str(fil)) for fil in filer]
+    stammer = [fil.stem for fil in filer]
+    navn = [
+        f"{fil.parent.name}/{stamme}" if stammer.count(stamme) > 1 and fil.parent.name else stamme
+        for fil, stamme in zip(filer, stammer)
+    ]
+    brukt = set()
+    for i, kandidat in enumerate(navn):
+        teller = 1
+        while navn[i] in brukt:
+            teller += 1
+            navn[i] = f"{kandidat} ({teller})"
+        brukt.add(navn[i])
+    kollisjoner = {}
+    for fil, stamme, unikt in zip(filer, stammer, navn):
+        if stammer.count(stamme) > 1:
+            kollisjoner.setdefault(fil.name, []).append(unikt)
+    return navn, kollisjoner
+
+
+def _les_arbeidsbok_jobb(kilde, ark_type):
+    try:
+        return les_arbeidsbok(hent_filbytes(kilde), ark_type), None
+    except Exception as e:
+        return None, str(e)
+
+
+def les_arbeidsboker(kilder, ark_type, pool=None):
+    # kilder are paths, bytes or file objects; returns (df, None) or (None, error message)
+    # per workbook in the same order, so one broken file does not stop the rest
+    if pool is None or len(kilder) < 2:
+        return [_les_arbeidsbok_jobb(kilde, ark_type) for kilde in kilder]
+    # Paths are sent as is, so the workers also do the file reading
+    kilder = [kilde if isinstance(kilde, (bytes, str, Path)) else hent_filbytes(kilde) for kilde in kilder]
+    return list(pool.map(_les_arbeidsbok_jobb, kilder, [ark_type] * len(kilder)))
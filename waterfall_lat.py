@@ -0,0 +1,31 @@
+# Heavy libraries imported on first use instead of when a module is imported, so the
+# Streamlit app can draw its first widgets before pandas, matplotlib and the rest
+# are loaded.
+#
+#   pd = lat_import("pandas", globals(), "pd")
+#
+# gives a stand-in that imports pandas the first time one of its attributes is used,
+# and then puts the real module in its place under the name "pd", so later lookups
+# cost nothing extra.
+import importlib
+
+
+class LatModul:
+    def __init__(self, navn, globale, alias):
+        self._navn = navn
+        self._globale = globale
+        self._alias = alias
+
+    def __getattr__(self, attributt):
+        # Only called for names the stand-in itself does not have
+        modul = importlib.import_module(self._navn)
+        if self._globale.get(self._alias) is self:
+            self._globale[self._alias] = modul
+        return getattr(modul, attributt)
+
+    def __repr__(self):
+        return f"<{self._navn}, importeres ved første bruk>"
+
+
+def lat_import(navn, globale, alias):
+    return LatModul(navn, globale, alias)
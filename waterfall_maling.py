@@ -0,0 +1,86 @@
+# Wall time, call count and peak memory per named stage for the current run.
+# Streamlit runs each session's script in its own thread, so measurements are kept
+# per thread; in threads (and worker processes) where no measurement is started,
+# maal does nothing.
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_lokal = threading.local()
+# tracemalloc is process-wide: it runs while at least one run measures memory, and
+# every stage of every run that is open while the peak is reset gets the peak so far
+_laas = threading.Lock()
+_minnebrukere = 0
+_apne_rammer = {}
+
+
+def start_maling(minne=False):
+    # Peak memory uses tracemalloc, which makes allocations noticeably slower, so it
+    # is only switched on while some run asks for it. It covers all Python
+    # allocations in the process, also those of other sessions running at the same time.
+    global _minnebrukere
+    stopp_maling()
+    _lokal.steg = {}
+    _lokal.minne = minne
+    if minne:
+        with _laas:
+            _minnebrukere += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+
+def stopp_maling():
+    # The stages measured so far: {stage: {"sekunder", "antall", "topp_mb"}}
+    global _minnebrukere
+    steg = getattr(_lokal, "steg", None)
+    _lokal.steg = None
+    if getattr(_lokal, "minne", False):
+        _lokal.minne = False
+        with _laas:
+            _minnebrukere -= 1
+            if _minnebrukere == 0 and tracemalloc.is_tracing():
+                tracemalloc.stop()
+    return steg or {}
+
+
+def maler():
+    # Whether a measurement is running in this thread
+    return getattr(_lokal, "steg", None) is not None
+
+
+@contextmanager
+def maal(navn):
+    # Also usable as a decorator. Nested stages are counted in full in the outer stage.
+    steg = getattr(_lokal, "steg", None)
+    if steg is None:
+        yield
+        return
+
+    minne = _lokal.minne
+    ramme = {"start": 0, "topp": 0}
+    if minne:
+        with _laas:
+            naa, topp = tracemalloc.get_traced_memory()
+            # Resetting the peak for this stage must not hide the peak so far of the
+            # stages still open, in this run or another
+            for apen in _apne_rammer.values():
+                apen["topp"] = max(apen["topp"], topp)
+            tracemalloc.reset_peak()
+            ramme = {"start": naa, "topp": naa}
+            _apne_rammer[id(ramme)] = ramme
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        tid = time.perf_counter() - start
+        if minne:
+            with _laas:
+                ramme["topp"] = max(ramme["topp"], tracemalloc.get_traced_memory()[1])
+                del _apne_rammer[id(ramme)]
+        maling = steg.setdefault(navn, {"sekunder": 0.0, "antall": 0, "topp_mb": None})
+        maling["sekunder"] += tid
+        maling["antall"] += 1
+        if minne:
+            topp_mb = (ramme["topp"] - ramme["start"]) / 2**20
+            maling["topp_mb"] = max(maling["topp_mb"] or 0.0, topp_mb)
@@ -1,95 +1,450 @@
-import pandas as pd
+import io
+import os
+import re
+import json
+import importlib
+import functools
+import platform
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
 from datetime import datetime, timedelta, date
-import numpy as np
-import matplotlib.pyplot as plt
 import streamlit as st
-from openpyxl import load_workbook
+from waterfall_grafer import (
+    tegn_graf_png, tegn_maned_oversikt_png, tegn_grafer, lag_prosesspool, graf_spec, lag_maned_oversikt_spec)
+from waterfall_eksport import eksport_bytes
+from waterfall_innlesing import (
+    arsaknavn, hent_filbytes, les_arbeidsbok, les_arbeidsboker, linjenavn, stoppkolonner, stoppvekter)
+from waterfall_lat import lat_import
+from waterfall_maling import maal, maler, start_maling, stopp_maling
 
-def les_data(uploaded_file):
+# Imported on first use, so the selectors are drawn before these are loaded (see varm_opp)
+pd = lat_import("pandas", globals(), "pd")
+np = lat_import("numpy", globals(), "np")
+pa = lat_import("pyarrow", globals(), "pa")
+pq = lat_import("pyarrow.parquet", globals(), "pq")
+Image = lat_import("PIL.Image", globals(), "Image")
+
+
+def les_data(uploaded_file, ark_type):
     if uploaded_file is not None:
         try:
-            if sheet_type == "slakt":
-                # Load data and extract comments for "slakt"
-                df = pd.read_excel(uploaded_file, header=2)
-                workbook = load_workbook(uploaded_file)
-                sheet = workbook.active
-
-                comments = []
-                for idx, row in enumerate(sheet.iter_rows(min_row=3, min_col=4, max_col=4), start=0):
-                    cell = row[0]
-                    if cell.comment:
-                        comment_text = cell.comment.text
-                        colon_count = 0
-                        hh_mm = ""
-                        for char in comment_text:
-                            if char == ":":
-                                colon_count += 1
-                            if colon_count >= 3 and char.isdigit():
-                                hh_mm += char
-                        comment_text = hh_mm.strip() if hh_mm else ""
-                    else:
-                        comment_text = ""
-                    comments.append(comment_text)
-
-                aligned_comments = comments[1:] + [""]
-                df["comments"] = aligned_comments[:len(df)]
-            else:
-                # Simple load for "filet"
-                df = pd.read_excel(uploaded_file, header=2)
-
-            return df
+            return les_arbeidsbok(hent_filbytes(uploaded_file), ark_type)
         except Exception as e:
             st.error(f"Feil ved lesing av Excel-filen: {e}")
             return None
     return None
 
 
+def normaliser_datoer(df):
+    # Raises ValueError if the first column does not hold timestamps
+    df.iloc[:, 0] = pd.to_datetime(df.iloc[:, 0], format="%Y-%m-%d %H:%M:%S")
+    df['Dato'] = df.iloc[:, 0].dt.date
+    return df
+
+
+#------------------------------
+#     CACHE FOR INNLESTE ARK
+#------------------------------
+
+# Prepared days are stored on disk per sheet type (see les_lager) and the last
+# versions read are kept in memory. Bump CACHE_VERSJON whenever the stored frame
+# changes shape.
+CACHE_VERSJON = 9
+MINNECACHE_STORRELSE = 8
+# Rendered charts are kept up to this many bytes per process (one chart at display
+# width is about 110 KB)
+GRAFCACHE_BYTES = 40 * 1024 * 1024
+# In the user's own cache folder, not the shared temp folder, so other users on the
+# machine cannot replace the stored days
+CACHE_MAPPE = Path(os.environ.get("WATERFALL_CACHE_DIR", Path.home() / ".cache" / "waterfall"))
+
+
+@st.cache_resource
+def _lru_cache(navn):
+    # One process-wide LRU per name, shared across reruns and sessions
+    # (the script itself is re-executed on every rerun), with the bytes it holds
+    return OrderedDict(), threading.Lock(), {"bytes": 0}
+
+
+def lru_hent(navn, nokkel):
+    cache, lock, _ = _lru_cache(navn)
+    with lock:
+        if nokkel in cache:
+            cache.move_to_end(nokkel)
+            return cache[nokkel]
+    return None
+
+
+def lru_lagre(navn, nokkel, verdi, maks_antall=None, maks_bytes=None):
+    # Bounded by the number of entries, or for bytes values by their total size
+    cache, lock, bruk = _lru_cache(navn)
+    with lock:
+        if maks_bytes is not None:
+            bruk["bytes"] += len(verdi) - len(cache.get(nokkel, b""))
+        cache[nokkel] = verdi
+        cache.move_to_end(nokkel)
+        while cache and ((maks_antall is not None and len(cache) > maks_antall)
+                         or (maks_bytes is not None and bruk["bytes"] > maks_bytes)):
+            _, gammel = cache.popitem(last=False)
+            if maks_bytes is not None:
+                bruk["bytes"] -= len(gammel)
+
+
+def lagre_parquet(df, sti, ekstra=None):
+    # Plain columnar Parquet: dates as date32, text as Arrow strings and the index
+    # as a column, described by pandas' JSON metadata. Nothing in the file is
+    # unpickled when it is read, so a file dropped into the folder cannot run code.
+    # ekstra is any JSON value kept alongside, see les_parquet_ekstra.
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    table = table.replace_schema_metadata({**table.schema.metadata, b"waterfall": json.dumps({"ekstra": ekstra})})
+
+    sti.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    tmp_sti = sti.with_suffix(".tmp")
+    pq.write_table(table, tmp_sti)
+    os.replace(tmp_sti, sti)
+
+
+def les_parquet(sti):
+    return pq.read_table(sti).to_pandas()
+
+
+def les_parquet_ekstra(sti):
+    # Only reads the file footer
+    return json.loads(pq.read_schema(sti).metadata[b"waterfall"])["ekstra"]
+
+
+#------------------------------
+#     LAGRET PRODUKSJONSHISTORIKK
+#------------------------------
+
+# All prepared production days ever uploaded are kept in one Parquet file per sheet
+# type and line, indexed on Dato. Each row carries the hash of the workbook row it
+# came from ('radhash'), so a new upload of the same history plus a few days only
+# prepares the rows that are new or changed. Days missing from a later upload are kept.
+# A single uploaded workbook is stored without a line name.
+LAGER_MAPPE = Path(os.environ.get("WATERFALL_LAGER_DIR", CACHE_MAPPE))
+MAKS_KJENTE_FILER = 500
+
+
+def _lager_sti(ark_type, linje=None):
+    if linje is None:
+        return LAGER_MAPPE / f"lager_{ark_type}_v{CACHE_VERSJON}.parquet"
+    return LAGER_MAPPE / f"lager_{ark_type}_{re.sub(r'[^0-9A-Za-z_-]+', '_', linje)}_v{CACHE_VERSJON}.parquet"
+
+
+@st.cache_resource
+def _lager_lock(ark_type, linje=None):
+    # Two sessions uploading at the same time must not both rewrite the store
+    return threading.Lock()
+
+
+@maal("les_lager")
+def les_lager(ark_type, linje=None):
+    # (prepared days or None, hashes of the workbooks already in the store).
+    # The last version read is kept in memory until the file changes.
+    sti = _lager_sti(ark_type, linje)
+    try:
+        status = sti.stat()
+    except FileNotFoundError:
+        return None, []
+    nokkel = (sti.name, status.st_mtime_ns, status.st_size)
+    lager = lru_hent("lager", nokkel)
+    if lager is not None:
+        return lager
+    try:
+        lager = les_parquet(sti), les_parquet_ekstra(sti)["filer"]
+    except Exception:
+        # A broken store is simply rebuilt from the next upload
+        return None, []
+    lru_lagre("lager", nokkel, lager, MINNECACHE_STORRELSE)
+    return lager
+
+
+@maal("lagre_lager")
+def lagre_lager(ark_type, linje, df, filer):
+    sti = _lager_sti(ark_type, linje)
+    filer = filer[-MAKS_KJENTE_FILER:]
+    lagre_parquet(df, sti, {"filer": filer})
+    status = sti.stat()
+    lru_lagre("lager", (sti.name, status.st_mtime_ns, status.st_size), (df, filer), MINNECACHE_STORRELSE)
+    glem_delte_datasett(ark_type)
+
+
+def tom_lager(ark_type, linjer):
+    # Removes the stored days of the given lines (None for a single workbook)
+    for linje in linjer:
+        with _lager_lock(ark_type, linje):
+            _lager_sti(ark_type, linje).unlink(missing_ok=True)
+    glem_delte_datasett(ark_type)
+
+
+def oppdater_lager(ra_df, lager, ark_type):
+    # Merges a freshly read workbook (les_data) into the stored days.
+    # Returns (merged days, number of days that were prepared).
+    radhash = pd.util.hash_pandas_object(ra_df, index=False)
+    dato = pd.to_datetime(ra_df.iloc[:, 0], format="%Y-%m-%d %H:%M:%S", errors="coerce").dt.normalize()
+    if lager is None:
+        endret = pd.Series(True, index=ra_df.index)
+    else:
+        ukjent = ~radhash.isin(lager['radhash'])
+        # All rows of a touched date are prepared again, so the first row still wins
+        endret = ukjent | dato.isin(dato[ukjent])
+    if not endret.any():
+        return lager, 0
+
+    # Raises ValueError like forbered_datasett
+    nye = forbered_datasett(ra_df[endret.to_numpy()], ark_type)
+    nye['radhash'] = radhash[endret].groupby(dato[endret]).first().reindex(nye.index).to_numpy()
+    if lager is None:
+        return nye, len(nye)
+    df = pd.concat([lager.drop(index=nye.index, errors="ignore"), nye])
+    return df.sort_index(kind="stable"), len(nye)
+
+
+def lagre_arbeidsbok(ra_df, filhash, ark_type, linje=None):
+    # Merges one read workbook into the store of its line.
+    # Returns (all stored days of the line, number of days that were prepared).
+    with _lager_lock(ark_type, linje):
+        lager, filer = les_lager(ark_type, linje)
+        if filhash in filer:
+            return lager, 0
+        df, antall_nye = oppdater_lager(ra_df, lager, ark_type)
+        try:
+            lagre_lager(ark_type, linje, df, filer + [filhash])
+        except OSError:
+            pass
+    return df, antall_nye
+
+
+@maal("last_data")
+def last_data(uploaded_file, ark_type):
+    # Merges the upload into the stored history of this sheet type and returns all
+    # stored days. A workbook that is already in the store is not read at all.
+    data = hent_filbytes(uploaded_file)
+    filhash = hashlib.sha256(data).hexdigest()
+    lager, filer = les_lager(ark_type)
+    if filhash in filer:
+        return lager
+
+    ra_df = les_data(data, ark_type)
+    if ra_df is None:
+        return None
+    try:
+        df, antall_nye = lagre_arbeidsbok(ra_df, filhash, ark_type)
+    except ValueError as e:
+        st.error(f"Feil ved behandling av datoer: {e}")
+        return None
+    if antall_nye:
+        st.sidebar.caption(f"{antall_nye} nye eller endrede dager lagt til i historikken.")
+    return df
+
+
+@maal("last_linjer")
+def last_linjer(kilder, ark_type, pool=None):
+    # kilder maps a line name to its workbook (uploaded file, bytes or path). The
+    # workbooks that are not in their line's store yet are read concurrently in the
+    # pool. Returns (stored days of all lines with a 'linje' column or None,
+    # [(line, error message)] for the workbooks that could not be used).
+    filhasher = {}
+    dager = {}
+    ukjente = []
+    for linje, kilde in kilder.items():
+        data = hent_filbytes(kilde)
+        filhasher[linje] = hashlib.sha256(data).hexdigest()
+        lager, filer = les_lager(ark_type, linje)
+        if filhasher[linje] in filer:
+            dager[linje] = lager
+        else:
+            ukjente.append((linje, kilde if isinstance(kilde, (str, Path)) else data))
+
+    feil = []
+    antall_nye = 0
+    with maal("les_arbeidsboker"):
+        lest = les_arbeidsboker([kilde for _, kilde in ukjente], ark_type, pool)
+    for (linje, _), (ra_df, melding) in zip(ukjente, lest):
+        if ra_df is None:
+            feil.append((linje, f"Feil ved lesing av Excel-filen: {melding}"))
+            continue
+        try:
+            dager[linje], nye = lagre_arbeidsbok(ra_df, filhasher[linje], ark_type, linje)
+        except ValueError as e:
+            feil.append((linje, f"Feil ved behandling av datoer: {e}"))
+            continue
+        antall_nye += nye
+    if antall_nye:
+        st.sidebar.caption(f"{antall_nye} nye eller endrede dager lagt til i historikken.")
+
+    if not dager:
+        return None, feil
+    df = pd.concat([dager[linje].assign(linje=linje) for linje in kilder if linje in dager])
+    return df, feil
+
+
+#------------------------------
+#     DATASETT FOR ØKTEN
+#------------------------------
+
+# Sessions that upload the same workbooks share one copy of the loaded days: a
+# process-wide entry per sheet type and workbook contents that counts the sessions
+# holding it and is dropped when the last one lets go. The shared frames are never
+# changed in place (with copy-on-write, filtering them makes copies), so any number
+# of sessions can read them at once.
+# Each session keeps its share, and the tables derived from the days it shows, in
+# its session state. A rerun with the same upload loads nothing, and the reports,
+# which are fragments that rerun on their own when one of their widgets changes,
+# reuse the averages.
+
+@st.cache_resource
+def _delte_datasett():
+    # {(sheet type, workbook hashes, line names): {"df", "feil", "kvalitet", "okter"}}. Reentrant, since the
+    # garbage collector may release a share in a thread that already holds the lock.
+    return {}, threading.RLock()
+
+
+def _slipp_datasett(delte, lock, nokkel, oppforing):
+    with lock:
+        oppforing["okter"] -= 1
+        if oppforing["okter"] <= 0 and delte.get(nokkel) is oppforing:
+            del delte[nokkel]
+
+
+class Datasettandel:
+    # One session's hold on a shared dataset. It is released when the session state
+    # drops it: on a new upload, when the history is cleared or when the session ends.
+    def __init__(self, nokkel, oppforing, delte, lock):
+        self.df = oppforing["df"]
+        self.feil = oppforing["feil"]
+        self.kvalitet = oppforing["kvalitet"]
+        weakref.finalize(self, _slipp_datasett, delte, lock, nokkel, oppforing)
+
+
+def ta_andel(nokkel, df=None, feil=None, kvalitet=None):
+    # A new share of the dataset of nokkel. If no session holds it, df, feil and the
+    # quality report are shared under nokkel, or None is returned when df is not given.
+    delte, lock = _delte_datasett()
+    with lock:
+        oppforing = delte.get(nokkel)
+        if oppforing is None:
+            if df is None:
+                return None
+            oppforing = delte[nokkel] = {"df": df, "feil": feil, "kvalitet": kvalitet, "okter": 0}
+        oppforing["okter"] += 1
+    return Datasettandel(nokkel, oppforing, delte, lock)
+
+
+def glem_delte_datasett(ark_type):
+    # Once the store of a sheet type changes, a new upload is merged with it again
+    # instead of getting days merged with the older store. Sessions holding the old
+    # days keep them.
+    delte, lock = _delte_datasett()
+    with lock:
+        for nokkel in [nokkel for nokkel in delte if nokkel[0] == ark_type]:
+            delte.pop(nokkel, None)
+
+
+def delte_datasett_status():
+    # (number of shared datasets, number of session shares in them)
+    delte, lock = _delte_datasett()
+    with lock:
+        oppforinger = list(delte.values())
+    return len(oppforinger), sum(oppforing["okter"] for oppforing in oppforinger)
+
+
+def hent_datasett(ark_type, uploaded_files):
+    # (all stored days for the upload or None, [(line, error message)])
+    okt_nokkel = (ark_type, tuple(f.file_id for f in uploaded_files))
+    datasett = st.session_state.get("datasett")
+    if datasett is not None and datasett["nokkel"] == okt_nokkel:
+        return datasett["andel"].df, datasett["andel"].feil
+
+    # One workbook per line, named after the file
+    linjer, _ = linjenavn([f.name for f in uploaded_files])
+    nokkel = (ark_type, tuple(hashlib.sha256(hent_filbytes(f)).hexdigest() for f in uploaded_files), tuple(linjer))
+    andel = ta_andel(nokkel)
+    if andel is None:
+        if len(uploaded_files) == 1:
+            df, feil = last_data(uploaded_files[0], ark_type), []
+        else:
+            kilder = dict(zip(linjer, uploaded_files))
+            try:
+                df, feil = last_linjer(kilder, ark_type, _prosesspool())
+            except BrokenProcessPool:
+                # A worker died and took the pool with it; read here and start a new pool next time
+                _prosesspool.clear()
+                df, feil = last_linjer(kilder, ark_type)
+        if df is None:
+            # A failed upload is read again on the next rerun so its error is shown again
+            return df, feil
+        # Checked once per upload, like the days themselves
+        andel = ta_andel(nokkel, df, feil, kvalitetsrapport(df, ark_type))
+    st.session_state["datasett"] = {"nokkel": okt_nokkel, "andel": andel}
+    return andel.df, andel.feil
+
+
+class Analysekontekst:
+    # What the reports of one run work on, passed to them explicitly. Streamlit runs
+    # the scripts of concurrent sessions as threads of one process, so none of this
+    # can be kept in module globals.
+    def __init__(self, ark_type, parallell_rendering=False, interaktive_grafer=False, detaljert=False):
+        self.ark_type = ark_type
+        self.oee_100 = OEE_100[ark_type]
+        self.stiplet_hoyde = STIPLET_HOYDE[ark_type]
+        self.parallell_rendering = parallell_rendering
+        self.interaktive_grafer = interaktive_grafer
+        # Split the stop bar into its causes and add a Pareto chart of them
+        self.detaljert = detaljert
+        # The days the reports show and the tables derived from them, see velg_analysedata
+        self.df = None
+        self.analyse = None
+
+
+def velg_analysedata(kontekst, df, nokkel):
+    # The days the reports show; the derived tables are kept while they stay the same
+    analyse = st.session_state.get("analyse")
+    if analyse is None or analyse["nokkel"] != nokkel:
+        analyse = {"nokkel": nokkel, "df": df}
+        st.session_state["analyse"] = analyse
+    kontekst.analyse = analyse
+    kontekst.df = analyse["df"]
+    return kontekst.df
+
+
+def avledet(kontekst, navn, lag):
+    # A table derived from the days shown, made on first use, e.g. avledet(kontekst, "uker", ukesnitt)
+    analyse = kontekst.analyse
+    if navn not in analyse:
+        analyse[navn] = lag(analyse["df"], kontekst.ark_type)
+    return analyse[navn]
+
+
+def glem_datasett():
+    st.session_state.pop("datasett", None)
+    st.session_state.pop("analyse", None)
+
+
+MANEDSNAVN = ["Januar", "Februar", "Mars", "April", "Mai", "Juni", "Juli", "August", "September", "Oktober", "November", "Desember"]
+# 100 % OEE capacity and the 80 % target line (fish per minute) per sheet type
+OEE_100 = {"slakt": 150, "filet": 25}
+STIPLET_HOYDE = {"slakt": 120, "filet": 20}
+
+
 def velg_dato():
     år = st.number_input("Velg år:", min_value=2024, max_value=datetime.now().year)
-    maneder = ["Januar", "Februar", "Mars", "April", "Mai", "Juni", "Juli", "August", "September", "Oktober", "November", "Desember"]
-    maaned = st.selectbox("Velg måned:", list(range(1, 13)), format_func=lambda x: maneder[x-1])
+    maaned = st.selectbox("Velg måned:", list(range(1, 13)), format_func=lambda x: MANEDSNAVN[x-1])
     dag = st.number_input("Velg dag (1-31):", min_value=1, max_value=31)
     valgt_dato = datetime(år, maaned, dag)
     return valgt_dato
 
-def hent_uke_dager(år, uke_nummer):
-    dager = []
-
-    # Handle edge case for week 1
-    if uke_nummer == 1:
-        forrige_år = år - 1
-        uke_forrige_år = 52
-        if date(forrige_år, 12, 28).isocalendar()[1] == 53:
-            uke_forrige_år = 53
-        # Find Thursday of the last week of the previous year using isocalendar
-        torsdag_forrige_uke = date.fromisocalendar(forrige_år, uke_forrige_år, 4)
-    else:
-        # Normal case: Find Thursday of the previous week using isocalendar
-        torsdag_forrige_uke = date.fromisocalendar(år, uke_nummer - 1, 4)
-
-    # Convert to datetime and add Thursday and Friday from the previous week
-    torsdag_forrige_uke_dt = datetime.combine(torsdag_forrige_uke, datetime.min.time())
-    dager += [torsdag_forrige_uke_dt, torsdag_forrige_uke_dt + timedelta(days=1)]  # Thursday and Friday
-
-    # Check and add Saturday and Sunday from the previous week if they exist in the production data
-    lørdag_forrige_uke = torsdag_forrige_uke_dt + timedelta(days=2)  # Saturday
-    søndag_forrige_uke = torsdag_forrige_uke_dt + timedelta(days=3)  # Sunday
-    if lørdag_forrige_uke.date() in df['Dato'].values:
-        dager.append(lørdag_forrige_uke)
-    if søndag_forrige_uke.date() in df['Dato'].values:
-        dager.append(søndag_forrige_uke)
-
-    # Add Monday, Tuesday, and Wednesday from the current week using isocalendar
-    try:
-        # Calculate the Monday of the given ISO week directly
-        monday = date.fromisocalendar(år, uke_nummer, 1)
-        dager += [datetime.combine(monday + timedelta(days=i), datetime.min.time()) for i in range(3)]
-    except ValueError as e:
-        st.write(f"Error calculating days for year {år}, week {uke_nummer}: {e}")
-    date_only = []
-    for i in dager:
-        date_only.append(i.strftime("%Y-%m-%d"))
-    return date_only
+def hent_uke_dager(df, år, uke_nummer):
+    # Production week N runs from Thursday in ISO week N-1 to Wednesday in ISO week N
+    # (Saturday and Sunday only count if there was production). Raises ValueError
+    # if the year has no such week.
+    mandag = date.fromisocalendar(år, uke_nummer, 1)
+    return hent_periode(df, mandag - timedelta(days=4), mandag + timedelta(days=2))
 
 
 
@@ -109,126 +464,477 @@ def hent_uke_dager(år, uke_nummer):
 #         return []
 
 
-def hent_maned_dager(år, maned):
-    dager = []
+def hent_maned_dager(df, år, maned):
     try:
-        for _, row in df.iterrows():
-            dato = row['Dato']
-            if dato.year == år and dato.month == maned:
-                dager.append(dato)
+        fra = date(år, maned, 1)
+        til = date(år + (maned == 12), maned % 12 + 1, 1) - timedelta(days=1)
+        return hent_periode(df, fra, til)
     except Exception as e:
         st.error(f"Feil ved henting av dager for måneden: {e}")
-    return dager
+        return df.iloc[:0]
 
 
-def beregn_stopptid(row):
-    try:
-        if sheet_type == "slakt":
-            stopptid = (
-                row.iloc[27:31].fillna(0).sum() +
-                row.iloc[34:40].fillna(0).sum() / 6 +
-                row.iloc[40:51].fillna(0).sum()
-            )
-        elif sheet_type == "filet":
-            stopptid = row.iloc[32:52].fillna(0).sum()
-        return stopptid
-    except Exception as e:
-        st.error(f"Feil ved beregning av stopptid: {e}")
+@maal("beregn_stopptid")
+def beregn_stopptid_alle(df, ark_type):
+    # Stop time in minutes for every row at once: the stop columns times their weights
+    # in SKJEMA. Rows with text in a stop column cannot be summed and get NaN, like the
+    # per-row calculation used to reject them.
+    stopptid = stoppminutter(df, ark_type) @ stoppvekter(ark_type)
+    stopptid[df['stopp_tekst'].to_numpy()] = np.nan
+    return stopptid
+
+
+def stoppminutter(df, ark_type):
+    # (rows × stop columns) matrix of the minutes entered, empty cells as 0
+    return np.nan_to_num(df[stoppkolonner(ark_type)].to_numpy(dtype=float))
+
+
+@maal("forbered_datasett")
+def forbered_datasett(df, ark_type):
+    df = normaliser_datoer(df)
+    df['stopptid'] = beregn_stopptid_alle(df, ark_type)
+    arbeidstimer, antall_fisk, avvik = beregn_produksjon_alle(df, ark_type)
+    df['arbeidstimer'] = arbeidstimer
+    df['antall_fisk'] = antall_fisk
+    df = kontroller_kvalitet(df, avvik)
+    return legg_til_kpi(indekser_paa_dato(df), ark_type)
+
+
+#------------------------------
+#     DAGLIGE NØKKELTALL
+#------------------------------
+
+KPI_KOLONNER = ['stopptid', 'arbeidstimer', 'antall_fisk', 'stopptid_takt', 'faktisk_takt', 'annet']
+
+
+def beregn_takt(stopptid, arbeidstimer, antall_fisk, ark_type, oee_100=None):
+    # Takt values per minute rounded to 2 decimals; annet is what is left of 100% OEE.
+    # oee_100 replaces the capacity of ark_type, also as an array that broadcasts
+    # against the other arguments (see beregn_scenarier).
+    if oee_100 is None:
+        oee_100 = OEE_100[ark_type]
+    stopptid_takt = np.round(stopptid * oee_100 / arbeidstimer, 2)
+    faktisk_takt = np.round(antall_fisk / arbeidstimer, 2)
+    annet = np.round(oee_100 - stopptid_takt - faktisk_takt, 2)
+    return stopptid_takt, faktisk_takt, annet
+
+
+def legg_til_kpi(df, ark_type):
+    # Daily KPI columns plus the keys used for week and month aggregation
+    df['gyldig'] = df['stopptid'].notna() & df['arbeidstimer'].notna() & (df['avvik'] == "")
+    df['stopptid_takt'], df['faktisk_takt'], df['annet'] = beregn_takt(
+        df['stopptid'], df['arbeidstimer'], df['antall_fisk'], ark_type)
+
+    # Thursday to Sunday belong to the next production week, see hent_uke_dager
+    uke_nokkel = (df.index + pd.Timedelta(days=4)).isocalendar()
+    df['uke_år'] = uke_nokkel['year'].to_numpy()
+    df['uke'] = uke_nokkel['week'].to_numpy()
+    df['år'] = df.index.year
+    df['måned'] = df.index.month
+    return df
+
+
+def kpi_tabell(df):
+    return df.loc[df['gyldig'], KPI_KOLONNER]
+
+
+def _snitt(df, nokkel, ark_type):
+    # Average stop time, working time and fish count over the valid days in each
+    # group, then takt values from the averages like the weekly/monthly graphs
+    gyldige = df[df['gyldig']]
+    grupper = gyldige.groupby(nokkel)
+    snitt = grupper[['stopptid', 'arbeidstimer', 'antall_fisk']].mean()
+    snitt['stopptid_takt'], snitt['faktisk_takt'], snitt['annet'] = beregn_takt(
+        snitt['stopptid'], snitt['arbeidstimer'], snitt['antall_fisk'], ark_type)
+    snitt['antall_dager'] = grupper.size()
+    return snitt
+
+
+def ukesnitt(df, ark_type):
+    return _snitt(df, ['uke_år', 'uke'], ark_type)
+
+
+def manedsnitt(df, ark_type):
+    return _snitt(df, ['år', 'måned'], ark_type)
+
+
+def eksport_tabeller(df, ark_type):
+    # The daily KPI table, the weekly and monthly averages and the quality report as
+    # plain tables for waterfall_eksport, per line when df holds several lines
+    linje = ['linje'] if 'linje' in df.columns else []
+    dager = df[linje + ['uke_år', 'uke', 'gyldig'] + KPI_KOLONNER + ['avvik', 'produksjonsmerknad']]
+    return {
+        "dager": dager.reset_index(),
+        "uker": _snitt(df, linje + ['uke_år', 'uke'], ark_type).reset_index(),
+        "maneder": _snitt(df, linje + ['år', 'måned'], ark_type).reset_index(),
+        "kvalitet": kvalitetsrapport(df, ark_type),
+    }
+
+
+def lag_periodesummer(df, ark_type):
+    # Cumulative sums over the valid days with a leading zero, so the totals of any
+    # date range are the difference of two entries (see periode_kpi). "arsaker" holds
+    # the same for the weighted minutes of every stop cause, one column per cause.
+    gyldige = df[df['gyldig']]
+    summer = {"datoer": gyldige.index.to_numpy(dtype="datetime64[ns]")}
+    for kolonne in ['stopptid', 'arbeidstimer', 'antall_fisk']:
+        summer[kolonne] = np.concatenate(([0.0], np.cumsum(gyldige[kolonne].to_numpy(dtype=float))))
+    arsaker = arsak_minutter(gyldige, ark_type)
+    summer["arsaker"] = np.vstack((np.zeros((1, arsaker.shape[1])), np.cumsum(arsaker, axis=0)))
+    return summer
+
+
+def hent_periodesummer(df, ark_type):
+    # Built once per dataset and shared across reruns, so moving the period slider
+    # only does the lookups
+    kolonner = ['gyldig', 'stopptid', 'arbeidstimer', 'antall_fisk'] + stoppkolonner(ark_type)
+    nokkel = (ark_type, int(pd.util.hash_pandas_object(df[kolonner]).sum()))
+    summer = lru_hent("periodesummer", nokkel)
+    if summer is None:
+        summer = lag_periodesummer(df, ark_type)
+        lru_lagre("periodesummer", nokkel, summer, MINNECACHE_STORRELSE)
+    return summer
+
+
+def periode_kpi(summer, fra, til, ark_type):
+    # Averages over the valid days from and including fra to and including til, the
+    # same numbers as ukesnitt/manedsnitt give for a week or month. fra and til may
+    # be arrays to answer many ranges at once; one row per range, NaN without days.
+    forste, etter_siste = _periodegrenser(summer, fra, til)
+    antall_dager = etter_siste - forste
+
+    snitt = pd.DataFrame({"antall_dager": antall_dager})
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for kolonne in ['stopptid', 'arbeidstimer', 'antall_fisk']:
+            sum_kolonne = summer[kolonne][etter_siste] - summer[kolonne][forste]
+            snitt[kolonne] = np.where(antall_dager > 0, sum_kolonne / antall_dager, np.nan)
+        snitt['stopptid_takt'], snitt['faktisk_takt'], snitt['annet'] = beregn_takt(
+            snitt['stopptid'], snitt['arbeidstimer'], snitt['antall_fisk'], ark_type)
+    return snitt
+
+
+def _periodegrenser(summer, fra, til):
+    # Positions in the cumulative sums of the first valid day of each range and of the
+    # one after its last, equal for a range without days
+    datoer = summer["datoer"]
+    fra = pd.to_datetime(np.atleast_1d(fra)).to_numpy(dtype="datetime64[ns]")
+    til = pd.to_datetime(np.atleast_1d(til)).to_numpy(dtype="datetime64[ns]")
+    forste = np.searchsorted(datoer, fra, side="left")
+    etter_siste = np.searchsorted(datoer, til, side="right")
+    return forste, np.maximum(etter_siste, forste)
+
+
+def rullerende_kpi(summer, dager, uker, ark_type):
+    # Averages over the uker weeks up to and including each of dager
+    dager = pd.DatetimeIndex(dager)
+    snitt = periode_kpi(summer, dager - pd.Timedelta(weeks=uker) + pd.Timedelta(days=1), dager, ark_type)
+    snitt.index = dager
+    return snitt
+
+
+#------------------------------
+#     STOPPÅRSAKER
+#------------------------------
+
+# The stop takt of every cause, i.e. its share of the stop bar. Each is computed like
+# stopptid_takt but from that cause's minutes alone, so before rounding the causes of
+# a day, week or month add up to its stopptid_takt.
+
+
+def arsak_minutter(df, ark_type):
+    # (days × causes) matrix of weighted stop minutes; its rows sum to stopptid
+    return stoppminutter(df, ark_type) * stoppvekter(ark_type)
+
+
+def _arsak_takt(minutter, arbeidstimer, ark_type):
+    # minutter may be summed over several days as long as arbeidstimer is summed over
+    # the same days: the ratio of the sums is the ratio of the averages
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return minutter * OEE_100[ark_type] / arbeidstimer[:, None]
+
+
+def arsak_dager(df, ark_type):
+    # Stop takt per cause for every valid day
+    gyldige = df[df['gyldig']]
+    takt = _arsak_takt(arsak_minutter(gyldige, ark_type), gyldige['arbeidstimer'].to_numpy(dtype=float), ark_type)
+    return pd.DataFrame(takt, index=gyldige.index, columns=arsaknavn(ark_type))
+
+
+def _arsak_snitt(df, nokkel, ark_type):
+    # Stop takt per cause over the valid days of each week or month. The days are
+    # sorted, so every group is a run of rows and one reduceat sums them all.
+    gyldige = df[df['gyldig']]
+    grupper = gyldige[nokkel].to_numpy()
+    if not len(grupper):
+        return pd.DataFrame(columns=arsaknavn(ark_type), index=pd.MultiIndex.from_arrays([[], []], names=nokkel))
+    starter = np.flatnonzero(np.r_[True, (grupper[1:] != grupper[:-1]).any(axis=1)])
+    minutter = np.add.reduceat(arsak_minutter(gyldige, ark_type), starter, axis=0)
+    arbeidstimer = np.add.reduceat(gyldige['arbeidstimer'].to_numpy(dtype=float), starter)
+    indeks = pd.MultiIndex.from_arrays(grupper[starter].T, names=nokkel)
+    return pd.DataFrame(_arsak_takt(minutter, arbeidstimer, ark_type), index=indeks, columns=arsaknavn(ark_type))
+
+
+def arsak_ukesnitt(df, ark_type):
+    return _arsak_snitt(df, ['uke_år', 'uke'], ark_type)
+
+
+def arsak_manedsnitt(df, ark_type):
+    return _arsak_snitt(df, ['år', 'måned'], ark_type)
+
+
+def periode_arsaker(summer, fra, til, ark_type):
+    # Stop takt per cause over the valid days of each range, as periode_kpi
+    forste, etter_siste = _periodegrenser(summer, fra, til)
+    minutter = summer["arsaker"][etter_siste] - summer["arsaker"][forste]
+    arbeidstimer = summer["arbeidstimer"][etter_siste] - summer["arbeidstimer"][forste]
+    return pd.DataFrame(_arsak_takt(minutter, arbeidstimer, ark_type), columns=arsaknavn(ark_type))
+
+
+def arsak_rad(kontekst, navn, lag, nokkel):
+    # One row of a per-cause table derived from the days shown, or None when the
+    # detailed charts are switched off
+    if not kontekst.detaljert:
         return None
-    
+    return avledet(kontekst, navn, lag).loc[nokkel]
 
-def beregn_faktiskproduksjon(row):
-    try:
-        if sheet_type == "slakt":
-            # Handle edge cases for "slakt"
-            start_time = datetime.strptime(str(row.iloc[2]), "%H:%M:%S")
-            end_time_cell_value = str(row.iloc[3])
-
-            if end_time_cell_value in ["23:59:00", "00:00:00"]:
-                comment_text = row['comments']
-
-                if comment_text:
-                    try:
-                        if len(comment_text) == 4 and comment_text.isdigit():
-                            hh = int(comment_text[:2])
-                            mm = int(comment_text[2:])
-                            parsed_time = timedelta(hours=hh, minutes=mm)
-                        elif ":" in comment_text:
-                            hh, mm = map(int, comment_text.split(":"))
-                            parsed_time = timedelta(hours=hh, minutes=mm)
-                        else:
-                            raise ValueError("Invalid time format in comment.")
-                    except Exception as e:
-                        st.error(f"Could not parse time from comment: {e}")
-                        return None, None
-
-                    if end_time_cell_value == "23:59:00":
-                        end_time = timedelta(minutes=0) + parsed_time
-                    else:  # "00:00:00"
-                        end_time = timedelta(hours=24) + parsed_time
-
-                    end_time_datetime = datetime.combine(start_time.date(), datetime.min.time()) + end_time
-                    if end_time_datetime < start_time:
-                        end_time_datetime += timedelta(days=1)
-
-                    work_duration = end_time_datetime - start_time
-                else:
-                    st.error("Sluttidspunkt skrevet kan indikere sluttid etter kl 00:00, men ingen kommentar funnet.")
-                    end_time_datetime = datetime.strptime(end_time_cell_value, "%H:%M:%S")
-                    work_duration = end_time_datetime - start_time
-            else:
-                try:
-                    # Attempt to parse with the default format
-                    end_time_datetime = datetime.strptime(end_time_cell_value, "%H:%M:%S")
-                except ValueError:
-                    # Handle alternative time formats, including the specific '1900-01-01 00:00:00'
-                    possible_formats = ["%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%d-%m-%Y %H:%M:%S"]
-                    for fmt in possible_formats:
-                        try:
-                            end_time_datetime = datetime.strptime(end_time_cell_value, fmt)
-                            break
-                        except ValueError:
-                            continue
-                    else:
-                        st.error(f"Kunne ikke parse sluttidspunkt: {end_time_cell_value}")
-                        return None, None
-
-                work_duration = end_time_datetime - start_time
-                
-            arbeidstimer = work_duration.total_seconds() / 60
-            antall_fisk = row.iloc[5]
 
-        elif sheet_type == "filet":
-            start_time = datetime.strptime(str(row.iloc[6]), "%H:%M:%S")
-            end_time_cell_value = str(row.iloc[7])
+def arsak_par(arsaker):
+    # The causes with a stop, largest first, as (name, stop takt) pairs for a chart job
+    arsaker = arsaker.astype(float).round(2)
+    arsaker = arsaker[arsaker > 0].sort_values(ascending=False, kind="stable")
+    return tuple((navn, float(verdi)) for navn, verdi in arsaker.items())
 
-            try:
-                end_time_datetime = datetime.strptime(end_time_cell_value, "%H:%M:%S")
-            except ValueError:
-                possible_formats = ["%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%d-%m-%Y %H:%M:%S"]
-                for fmt in possible_formats:
-                    try:
-                        end_time_datetime = datetime.strptime(end_time_cell_value, fmt)
-                        break
-                    except ValueError:
-                        continue
-                else:
-                    st.error(f"Kunne ikke parse sluttidspunkt: {end_time_cell_value}")
-                    return None, None
-
-            work_duration = end_time_datetime - start_time
-            arbeidstimer = work_duration.total_seconds() / 60
-            antall_fisk = row.iloc[12]
-        if arbeidstimer < 0:
-            arbeidstimer += 24*60 
-        
-        return arbeidstimer, antall_fisk
 
-    except Exception as e:
-        st.error(f"Feil ved beregning av faktisk produksjon: {e}")
-        return None, None
+#------------------------------
+#     SCENARIOER
+#------------------------------
+
+# What-if scenarios: another 100% OEE capacity, another target line and a share of
+# each stop cause taken away. Every scenario is computed for every valid day at
+# once, as (scenarios × days) arrays.
+SCENARIO_KOLONNER = ["Scenario", "Kapasitet", "Mål"]
+
+
+def scenariogrunnlag(df, ark_type):
+    # The valid days' numbers every scenario starts from, made once per dataset
+    gyldige = df[df['gyldig']]
+    stopptid = gyldige['stopptid'].to_numpy(dtype=float)
+    arbeidstimer = gyldige['arbeidstimer'].to_numpy(dtype=float)
+    antall_fisk = gyldige['antall_fisk'].to_numpy(dtype=float)
+    # Fish per minute while the line runs; the minutes a scenario saves are run at this rate
+    kjoretid = arbeidstimer - stopptid
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kjorerate = np.where(kjoretid > 0, antall_fisk / kjoretid, 0.0)
+    return {"datoer": gyldige.index, "minutter": arsak_minutter(gyldige, ark_type), "stopptid": stopptid,
+            "arbeidstimer": arbeidstimer, "antall_fisk": antall_fisk, "kjorerate": kjorerate}
+
+
+def beregn_scenarier(grunnlag, ark_type, kapasitet, mal, reduksjon):
+    # kapasitet and mal hold one value per scenario, reduksjon one row per scenario
+    # with the share (0-1) taken away from each stop cause. A scenario with the
+    # current capacity and nothing taken away gives the daily KPI table.
+    kapasitet = np.asarray(kapasitet, dtype=float)[:, None]
+    mal = np.asarray(mal, dtype=float)[:, None]
+    spart = np.asarray(reduksjon, dtype=float) @ grunnlag["minutter"].T
+    # Not below zero when all of a cause is taken away and rounding leaves a little less
+    stopptid = np.maximum(grunnlag["stopptid"] - spart, 0)
+    antall_fisk = grunnlag["antall_fisk"] + spart * grunnlag["kjorerate"]
+    stopptid_takt, faktisk_takt, annet = beregn_takt(
+        stopptid, grunnlag["arbeidstimer"], antall_fisk, ark_type, kapasitet)
+    return {"stopptid": stopptid, "antall_fisk": antall_fisk, "stopptid_takt": stopptid_takt,
+            "faktisk_takt": faktisk_takt, "annet": annet, "avstand": np.round(mal - faktisk_takt, 2)}
+
+
+def scenario_tabell(grunnlag, scenarier, ark_type):
+    # One row per scenario: takt values from the averages over all days, like
+    # ukesnitt does for a week, and how many days reached the target.
+    # scenarier has SCENARIO_KOLONNER plus one column per cause with the percentage taken away.
+    kapasitet = scenarier["Kapasitet"].to_numpy(dtype=float)
+    mal = scenarier["Mål"].to_numpy(dtype=float)
+    reduksjon = scenarier[arsaknavn(ark_type)].to_numpy(dtype=float) / 100
+    dager = beregn_scenarier(grunnlag, ark_type, kapasitet, mal, reduksjon)
+    # nanmean skips days without a fish count, as the pandas means in _snitt do
+    stopptid_takt, faktisk_takt, annet = beregn_takt(
+        np.nanmean(dager["stopptid"], axis=1), grunnlag["arbeidstimer"].mean(),
+        np.nanmean(dager["antall_fisk"], axis=1), ark_type, kapasitet)
+    return pd.DataFrame({
+        "Scenario": scenarier["Scenario"].to_numpy(),
+        "Kapasitet": kapasitet,
+        "Mål": mal,
+        "Stopptid takt": stopptid_takt,
+        "Faktisk takt": faktisk_takt,
+        "Annet": annet,
+        "Avstand til mål": np.round(mal - faktisk_takt, 2),
+        "Dager på mål (%)": np.round((dager["faktisk_takt"] >= mal[:, None]).mean(axis=1) * 100, 1),
+    })
+
+
+def standard_scenarier(ark_type):
+    navn = arsaknavn(ark_type)
+    scenarier = pd.DataFrame(0.0, index=range(3), columns=SCENARIO_KOLONNER + navn)
+    scenarier["Scenario"] = ["Dagens", "Halvert omstillingstid", "10 % mindre stopp"]
+    scenarier["Kapasitet"] = float(OEE_100[ark_type])
+    scenarier["Mål"] = float(STIPLET_HOYDE[ark_type])
+    scenarier.loc[1, "Omstillinger"] = 50.0
+    scenarier.loc[2, navn] = 10.0
+    return scenarier
+
+
+def sveip_scenarier(ark_type, arsak, steg):
+    # The current capacity and target, with arsak (or all causes) cut from 0 to 100 %
+    navn = arsaknavn(ark_type)
+    andeler = np.arange(0, 100 + steg / 2, steg)
+    scenarier = pd.DataFrame(0.0, index=range(len(andeler)), columns=SCENARIO_KOLONNER + navn)
+    scenarier["Scenario"] = [f"{arsak} −{andel:g} %" for andel in andeler]
+    scenarier["Kapasitet"] = float(OEE_100[ark_type])
+    scenarier["Mål"] = float(STIPLET_HOYDE[ark_type])
+    for kolonne in navn if arsak == ALLE_ARSAKER else [arsak]:
+        scenarier[kolonne] = andeler
+    return scenarier
+
+
+def indekser_paa_dato(df):
+    # Sorted, unique DatetimeIndex on the production date: single days are hash
+    # lookups and weeks/months/ranges are contiguous slices. Rows without a date are
+    # dropped and for repeated dates the first row wins, as the old lookups did.
+    dato = pd.to_datetime(df['Dato'])
+    df = df[dato.notna().to_numpy()]
+    df.index = pd.DatetimeIndex(dato[dato.notna()], name="Dato").as_unit("ns")
+    df = df[~df.index.duplicated(keep="first")]
+    return df.sort_index(kind="stable")
+
+
+def hent_dag(df, dag):
+    # Row for one production day, or None if the day is not in the sheet
+    dag = pd.Timestamp(dag)
+    if dag not in df.index:
+        return None
+    return df.loc[dag]
+
+
+def hent_periode(df, fra, til):
+    # All production days from and including fra to and including til
+    return df.loc[pd.Timestamp(fra):pd.Timestamp(til)]
+
+
+MIDNATT_SLUTTIDER = ["23:59:00", "00:00:00"]
+
+# Every row is checked when it is prepared, all rows at once (beregn_produksjon_alle
+# and kontroller_kvalitet). A day that fails any check is left out of the KPIs and
+# averages; the checks it failed are kept in 'avvik' and listed in the quality report
+# of the upload (kvalitetsrapport). Per check: the message and the column holding the
+# value it is about.
+KVALITETSKONTROLLER = {
+    "starttid": ("Kunne ikke parse starttidspunkt", "start_tekst"),
+    "kommentar": ("Kunne ikke parse tid fra kommentar", "comments"),
+    "midnatt": ("Sluttidspunkt skrevet kan indikere sluttid etter kl 00:00, men ingen kommentar funnet", "slutt_tekst"),
+    "sluttid": ("Kunne ikke parse sluttidspunkt", "slutt_tekst"),
+    "varighet": ("Arbeidstiden er null eller negativ", None),
+    "produksjonstid": ("Stopptiden er lengre enn arbeidstiden", None),
+    "fisk": ("Mangler antall fisk", None),
+    "stopp": ("Tekst i en stoppkolonne", None),
+}
+
+
+@maal("beregn_produksjon")
+def beregn_produksjon_alle(df, ark_type):
+    # Working minutes and fish count for every row at once.
+    # Returns (arbeidstimer, antall_fisk, avvik) where avvik maps the time checks of
+    # KVALITETSKONTROLLER to a boolean array of the rows failing them; rows whose
+    # times could not be parsed have NaN arbeidstimer.
+    # les_arbeidsbok has parsed the times already
+    slutt_tekst = df['slutt_tekst'].astype(str)
+    start = df['start']
+    slutt = df['slutt']
+    avvik = {"starttid": start.isna()}
+    ugyldig = avvik["starttid"]
+
+    if ark_type == "slakt":
+        # 23:59 / 00:00 means the shift ended after midnight, the real end time is in the comment
+        midnatt = slutt_tekst.isin(MIDNATT_SLUTTIDER) & ~ugyldig
+        kommentar = df["comments"].fillna("").astype(str)
+        har_kommentar = midnatt & (kommentar != "")
+
+        deler = kommentar.str.extract(r"^(?:(\d{2})(\d{2})|\s*(\d+)\s*:\s*(\d+)\s*)$")
+        timer = pd.to_numeric(deler[0].fillna(deler[2]))
+        minutter = pd.to_numeric(deler[1].fillna(deler[3]))
+        kommentar_ok = har_kommentar & timer.notna()
+
+        avvik["kommentar"] = har_kommentar & ~kommentar_ok
+        ugyldig = ugyldig | avvik["kommentar"]
+
+        kommentar_slutt = (
+            pd.to_timedelta(np.where(slutt_tekst == "00:00:00", 24, 0), unit="h")
+            + pd.to_timedelta(timer.fillna(0), unit="h")
+            + pd.to_timedelta(minutter.fillna(0), unit="m")
+        )
+        kommentar_slutt = kommentar_slutt.where(kommentar_slutt >= start, kommentar_slutt + pd.Timedelta(days=1))
+        slutt = slutt.where(~kommentar_ok, kommentar_slutt)
+
+        # Without the comment the end time is a guess, so the day is left out
+        avvik["midnatt"] = midnatt & ~har_kommentar
+
+    avvik["sluttid"] = slutt.isna() & ~ugyldig
+    ugyldig = ugyldig | avvik["sluttid"]
+
+    arbeidstimer = ((slutt - start).dt.total_seconds() / 60).to_numpy(dtype=float, copy=True)
+    # An end time before the start time is a shift that ended after midnight
+    arbeidstimer[arbeidstimer < 0] += 24 * 60
+    arbeidstimer[ugyldig.to_numpy()] = np.nan
+
+    avvik = {kontroll: rader.to_numpy(dtype=bool) for kontroll, rader in avvik.items()}
+    return arbeidstimer, df['antall_fisk'].to_numpy(dtype=float, na_value=np.nan), avvik
+
+
+def kontroller_kvalitet(df, avvik):
+    # Adds the checks on the computed values to the time checks of
+    # beregn_produksjon_alle, and records the checks each row failed: their names in
+    # 'avvik' (comma separated, empty for a good row) and their messages in
+    # 'produksjonsmerknad'
+    avvik = {
+        **avvik,
+        "varighet": (df['arbeidstimer'] <= 0).to_numpy(),
+        "produksjonstid": (df['stopptid'] > df['arbeidstimer']).to_numpy(),
+        "fisk": df['antall_fisk'].isna().to_numpy(),
+        "stopp": df['stopp_tekst'].to_numpy(dtype=bool),
+    }
+    navn = pd.Series("", index=df.index, dtype=str)
+    merknad = pd.Series("", index=df.index, dtype=str)
+    for kontroll, (melding, kolonne) in KVALITETSKONTROLLER.items():
+        rader = avvik.get(kontroll)
+        if rader is None or not rader.any():
+            continue
+        if kolonne is not None:
+            melding = melding + ": " + df.loc[rader, kolonne].astype(str)
+        forste = navn[rader] == ""
+        navn[rader] = navn[rader] + np.where(forste, "", ",") + kontroll
+        merknad[rader] = merknad[rader] + np.where(forste, "", "; ") + melding
+    df['avvik'] = navn
+    df['produksjonsmerknad'] = merknad
+    return df
+
+
+def kvalitetsrapport(df, ark_type):
+    # One row per failed check of a prepared day, for all lines of an upload: the day,
+    # the check, its message and the value it is about
+    linje = ['linje'] if 'linje' in df.columns else []
+    flagget = df[(df['avvik'] != "").to_numpy()]
+    rapport = pd.DataFrame({
+        'Dato': flagget.index,
+        **{kolonne: flagget[kolonne].to_numpy() for kolonne in linje},
+        'kontroll': flagget['avvik'].str.split(",").to_numpy(),
+    }).explode("kontroll")
+    # Positions in flagget, one per check
+    rader = rapport.index.to_numpy()
+    rapport['melding'] = rapport['kontroll'].map({kontroll: melding for kontroll, (melding, _) in KVALITETSKONTROLLER.items()})
+    rapport['verdi'] = pd.Series(None, index=rapport.index, dtype=str)
+    for kontroll, (_, kolonne) in KVALITETSKONTROLLER.items():
+        valgt = (rapport['kontroll'] == kontroll).to_numpy()
+        if kolonne is not None and valgt.any():
+            rapport.loc[valgt, 'verdi'] = flagget[kolonne].iloc[rader[valgt]].astype(str).to_numpy()
+    return rapport.reset_index(drop=True)
+
 
-    
 def pen_dato(date):
     # Define Norwegian month names
     months = {
@@ -260,197 +966,239 @@ def pen_dato(date):
 
     return formatted_date
 
-    
-def lag_graph(annet,faktisk_takt, stopptid_takt, dag, graf_type):
 
-    if sheet_type == "slakt":
+@st.cache_resource
+def _prosesspool():
+    # Started on first use and kept until a worker dies (see hent_datasett)
+    return lag_prosesspool()
+
+
+# st.image scales wider images down to this width and encodes them again on every
+# call, so charts are kept at this width already and an unchanged chart costs nothing
+VISNINGSBREDDE = 1460
+
+
+def til_visningsbredde(png):
+    # The same bilinear scaling st.image would do
+    bilde = Image.open(io.BytesIO(png))
+    if bilde.width <= VISNINGSBREDDE:
+        return png
+    hoyde = int(1.0 * bilde.height * VISNINGSBREDDE / bilde.width)
+    buffer = io.BytesIO()
+    bilde.resize((VISNINGSBREDDE, hoyde), resample=Image.BILINEAR).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def hent_grafer_png(jobber, parallell_rendering=False):
+    # Rendered charts are shared across reruns and sessions, so an unchanged chart is
+    # never redrawn. The missing ones are drawn in one batch, in the process pool if
+    # parallel rendering is switched on.
+    pngs = [lru_hent("grafer", jobb) for jobb in jobber]
+    mangler = [i for i, png in enumerate(pngs) if png is None]
+    if mangler:
+        pool = _prosesspool() if parallell_rendering and len(mangler) > 1 else None
+        with maal("tegn_grafer"):
+            try:
+                nye = tegn_grafer([jobber[i] for i in mangler], pool)
+            except BrokenProcessPool:
+                # As in hent_datasett: draw them here and start a new pool next time
+                _prosesspool.clear()
+                nye = tegn_grafer([jobber[i] for i in mangler])
+        for i, png in zip(mangler, nye):
+            png = til_visningsbredde(png)
+            pngs[i] = png
+            lru_lagre("grafer", jobber[i], png, maks_bytes=GRAFCACHE_BYTES)
+    return pngs
+
+
+def graf_tekster(dag, graf_type, ark_type):
+    # Title and y-axis label for a chart
+    if ark_type == "slakt":
         tittel = "på slakt"
         fisk = "fisk"
-        
-    
-    elif sheet_type == "filet":
+    elif ark_type == "filet":
         tittel = "på filet"
         fisk = "filet"
-    
-    
-    fig, ax = plt.subplots(figsize=(10, 5), dpi=100)
-    stages = ['100% OEE', 'Stopptid', 'Annet']
-    values = [oee_100, -stopptid_takt, -annet]
-    cum_values = np.cumsum([0] + values).tolist()
-    value_starts = cum_values[:-1]
-    colors = ['blue', 'red', 'orange']
-    
-    
-    for i in range(len(stages)):
-        ax.bar(stages[i], values[i], bottom=value_starts[i], color=colors[i], edgecolor='black')
-
-    ax.bar('Takttid', faktisk_takt, bottom=0, color='green', edgecolor='black')
-    ax.bar('Takttid', stiplet_hoyde - faktisk_takt, bottom=faktisk_takt, color='none', edgecolor='green', hatch='//')
-
-    for i in range(len(stages)):
-        if stages[i] == 'Stopptid':
-            if sheet_type == "slakt":
-                if stopptid_takt < 9:
-                    # Place the text outside the bar if the value is less than 7
-                    dynamic_offset = value_starts[i] + values[i] -2  # Adjust `-10` for spacing
-                    ax.text(
-                        stages[i], dynamic_offset,
-                        f'{values[i]} ({abs(values[i]) / oee_100 * 100:.1f}%)',
-                        ha='center', va='top', color='black', fontweight='bold'
-                        )
-                else:
-                    # Place the text inside the bar if the value is greater than or equal to 7
-                    y_pos = value_starts[i] + values[i] / 2
-                    ax.text(
-                        stages[i], y_pos,
-                        f'{values[i]} ({abs(values[i]) / oee_100 * 100:.1f}%)',
-                        ha='center', va='center', color='black', fontweight='bold'
-                    )
-            elif sheet_type == "filet":
-                if stopptid_takt < 1.5:
-                    # Place the text outside the bar if the value is less than 7
-                        dynamic_offset = value_starts[i] + values[i]-0.5 # Adjust `-10` for spacing
-                        ax.text(
-                            stages[i], dynamic_offset,
-                            f'{values[i]} ({abs(values[i]) / oee_100 * 100:.1f}%)',
-                            ha='center', va='top', color='black', fontweight='bold'
-                        )
-                else:
-                    # Place the text inside the bar if the value is greater than or equal to 7
-                    y_pos = value_starts[i] + values[i] / 2
-                    ax.text(
-                        stages[i], y_pos,
-                        f'{values[i]} ({abs(values[i]) / oee_100 * 100:.1f}%)',
-                        ha='center', va='center', color='black', fontweight='bold'
-                    )
-        else:
-            # Place the text inside other bars as before
-            y_pos = value_starts[i] + values[i] / 2
-            ax.text(
-                stages[i], y_pos,
-                f'{values[i]} ({abs(values[i]) / oee_100 * 100:.1f}%)',
-                ha='center', va='center', color='black', fontweight='bold'
-            )
-
-    ax.text(
-        'Takttid', faktisk_takt / 2,
-        f'{faktisk_takt} ({(faktisk_takt / oee_100 * 100):.1f}%)',
-        ha='center', va='center', color='black', fontweight='bold'
-    )
 
-    gap_to_80 = stiplet_hoyde - faktisk_takt
-    ax.text(
-        'Takttid', stiplet_hoyde + 1,
-        f'{round(gap_to_80, 2)} ({(gap_to_80 / oee_100 * 100):.1f}%)',
-        ha='center', va='bottom', color='green', fontweight='bold'
-    )
-    
-    
+    ylabel = f'Antall {fisk} produsert per minutt'
     if graf_type == "enkeltgraf":
-        dag = pen_dato(dag)
-        ax.set_ylabel(f'Antall {fisk} produsert per minutt')
-        ax.set_title(f'Daglig produksjon {tittel} {dag}')
-        st.pyplot(fig)
-        
+        return f'Daglig produksjon {tittel} {pen_dato(dag)}', ylabel
     elif graf_type == "ukesnitt":
-        ax.set_ylabel(f'Antall {fisk} produsert per minutt')
-        ax.set_title(f'Ukentlig gjennomsnitt {tittel} for uke {dag}')
-        st.pyplot(fig)
-        
+        return f'Ukentlig gjennomsnitt {tittel} for uke {dag}', ylabel
     elif graf_type == "manedsnitt":
-        ax.set_ylabel(f'Antall {fisk} produsert per minutt')
-        ax.set_title(f'Månedlig gjennomsnitt {tittel}  i {dag}')
-        st.pyplot(fig)
-        
-def enkelt_dato():
+        return f'Månedlig gjennomsnitt {tittel}  i {dag}', ylabel
+    elif graf_type == "periode":
+        return f'Gjennomsnitt {tittel} {dag}', ylabel
+
+
+def graf_jobb(kpi, dag, graf_type, ark_type):
+    # Plain arguments for tegn_graf_png; also the cache key of the rendered chart
+    tittel, ylabel = graf_tekster(dag, graf_type, ark_type)
+    return (float(kpi['annet']), float(kpi['faktisk_takt']), float(kpi['stopptid_takt']),
+            tittel, ylabel, ark_type, OEE_100[ark_type], STIPLET_HOYDE[ark_type])
+
+
+@maal("lag_graph")
+def lag_graph(kontekst, kpi, dag, graf_type, bestillinger=None, arsaker=None):
+    # kpi is one row of the daily KPI table or of the week/month averages.
+    # With a bestillinger list the chart's place on the page is reserved now and
+    # it is drawn later together with the rest of the batch (vis_bestilte_grafer).
+    # arsaker is the matching row of a per-cause table, see arsak_rad.
+    jobb = graf_jobb(kpi, dag, graf_type, kontekst.ark_type)
+    if arsaker is not None:
+        jobb = ("detaljert", arsak_par(arsaker)) + jobb
+    vis_graf(kontekst, jobb, bestillinger)
+
+
+def lag_pareto(kontekst, arsaker, dag, graf_type, bestillinger=None):
+    # The stop causes of a week, month or period, largest first
+    par = arsak_par(arsaker)
+    if not par:
+        st.write("Ingen stopp registrert.")
+        return
+    tittel, ylabel = graf_tekster(dag, graf_type, kontekst.ark_type)
+    vis_graf(kontekst, ("pareto", par, f"Stoppårsaker, {tittel[0].lower()}{tittel[1:]}", ylabel), bestillinger)
+
+
+def vis_graf(kontekst, jobb, bestillinger=None):
+    if kontekst.interaktive_grafer:
+        # Drawn by the browser, so there is nothing to batch
+        st.vega_lite_chart(graf_spec(jobb), width="stretch")
+    elif bestillinger is None:
+        st.image(hent_grafer_png([jobb])[0], width="stretch")
+    else:
+        bestillinger.append((st.empty(), jobb))
+
+
+@maal("vis_bestilte_grafer")
+def vis_bestilte_grafer(kontekst, bestillinger):
+    pngs = hent_grafer_png([jobb for _, jobb in bestillinger], kontekst.parallell_rendering)
+    for (plass, _), png in zip(bestillinger, pngs):
+        plass.image(png, width="stretch")
+    bestillinger.clear()
+
+
+
+@maal("manedsoversikt")
+def lag_maned_oversikt(kontekst, kpi, tittel):
+    # kpi holds the valid days of the month from the daily KPI table
+    dager = tuple(
+        (f"{pen_dato(dag).split()[0]} {dag.day}.{dag.month}.",
+         float(row['stopptid_takt']), float(row['faktisk_takt']), float(row['annet']))
+        for dag, row in kpi.iterrows()
+    )
+    if not dager:
+        return
+    jobb = (dager, f"Daglig produksjon på {kontekst.ark_type} i {tittel}", kontekst.ark_type,
+            kontekst.oee_100, kontekst.stiplet_hoyde)
+    if kontekst.interaktive_grafer:
+        # Small multiples keep their own size
+        st.vega_lite_chart(lag_maned_oversikt_spec(*jobb), width="content")
+        return
+    png = lru_hent("manedsoversikt", jobb)
+    if png is None:
+        png = til_visningsbredde(tegn_maned_oversikt_png(*jobb))
+        lru_lagre("manedsoversikt", jobb, png, maks_bytes=GRAFCACHE_BYTES // 4)
+    st.image(png, width="stretch")
+
+
+def malt_fragment(rapport):
+    # The reports are fragments, which rerun on their own when one of their widgets
+    # changes, without main and its measurement. Such a rerun measures itself and,
+    # with the diagnostics panel on, shows its stages below the report.
+    @functools.wraps(rapport)
+    def kjor(kontekst):
+        if maler():
+            return rapport(kontekst)
+        diagnostikk = st.session_state.get("diagnostikk", False)
+        start_maling(minne=diagnostikk)
+        try:
+            with maal(f"{rapport.__name__} (fragment)"):
+                rapport(kontekst)
+        finally:
+            steg = stopp_maling()
+        if diagnostikk:
+            with st.expander("Diagnostikk for siste oppdatering av rapporten", expanded=True):
+                st.dataframe(diagnostikk_tabell(steg), hide_index=True)
+
+    return st.fragment(kjor)
+
+
+def vis_utelatte_dager(dager):
+    # One message for the days of a week or month that failed the quality checks
+    # instead of one per bad day
+    utelatt = dager[~dager['gyldig']]
+    if len(utelatt):
+        st.error("Følgende dager er utelatt fordi verdiene ikke kunne beregnes:\n\n" + "\n".join(
+            f"- {dag:%d.%m.%Y}: {merknad}" for dag, merknad in utelatt['produksjonsmerknad'].items()))
+
+
+@malt_fragment
+def enkelt_dato(kontekst):
     valgt_dato = velg_dato()
     valgt_dato_enkel = valgt_dato.date()
-    if valgt_dato_enkel in df['Dato'].values:
-        row = df[df['Dato'] == valgt_dato_enkel].iloc[0]
-        stopptid = beregn_stopptid(row)
-        arbeidstimer, antall_fisk = beregn_faktiskproduksjon(row)
-        if stopptid is None or arbeidstimer is None or antall_fisk is None:
-            st.error("Kan ikke beregne verdier. Sjekk om du har valgt riktig filtype og lastet opp riktig fil.")
+    row = hent_dag(kontekst.df, valgt_dato_enkel)
+    if row is not None:
+        if not row['gyldig']:
+            st.error(f"Dagen er utelatt fordi verdiene ikke kunne beregnes: {row['produksjonsmerknad']}")
             return
         
-        stopptid_impact = stopptid * oee_100
-        stopptid_takt = round(stopptid_impact / arbeidstimer, 2)
-        faktisk_takt = round(antall_fisk / arbeidstimer, 2)
-        kjente_faktorer = round(stopptid_takt, 2)
-        annet = oee_100 - kjente_faktorer - faktisk_takt
-        annet = round(annet, 2)
         graf_type = "enkeltgraf"
         
-        lag_graph(
-            annet,
-            faktisk_takt, stopptid_takt,
-            valgt_dato,graf_type)
+        lag_graph(kontekst, row, valgt_dato, graf_type,
+                  arsaker=arsak_rad(kontekst, "arsaker_dager", arsak_dager, pd.Timestamp(valgt_dato_enkel)))
     else:
         st.warning("Datoen du valgte finnes ikke i input-arket. Dette er enten fordi du tastet inn en ugyldig dato eller fordi datoen ikke hadde noen produksjon (eks helg).")
     return        
     
 
-def uke():
+@malt_fragment
+def uke(kontekst):
     year = st.number_input("Velg år:", min_value=2024, max_value=datetime.now().year)
-    week_number = st.number_input("Velg uke nummer:", min_value=1, max_value=52)
-    week_days = hent_uke_dager(year, week_number)
-    daglig_data = []
-    for dag in week_days:
-        dag = datetime.strptime(dag, "%Y-%m-%d").date()
-        if dag in df['Dato'].values:
-            row = df[df['Dato'] == dag].iloc[0]
-            # Format with month as text
-            formatted_date = dag.strftime("%d. %B %Y")
-            # Print in Norwegian style
-            st.write(f"Dato: {formatted_date}")
-            stopptid = beregn_stopptid(row)
-            arbeidstimer, antall_fisk = beregn_faktiskproduksjon(row)
-            if stopptid is None or arbeidstimer is None or antall_fisk is None:
-                st.error(f"Kan ikke beregne verdier for {dag.strftime('%d.%m.%Y')}. Sjekk om du har valgt riktig filtype og lastet opp riktig fil.")
-                return
-            daglig_data.append((dag, stopptid, arbeidstimer, antall_fisk))
-            
-            stopptid_impact = stopptid * oee_100
-            stopptid_takt = round(stopptid_impact / arbeidstimer, 2)
-            faktisk_takt = round(antall_fisk / arbeidstimer, 2)
-            kjente_faktorer = round(stopptid_takt, 2)
-            annet = oee_100 - kjente_faktorer - faktisk_takt
-            annet = round(annet, 2)
-            graf_type = "enkeltgraf"
-            lag_graph(
-                annet,
-                faktisk_takt, stopptid_takt,
-                dag, graf_type)
+    week_number = st.number_input("Velg uke nummer:", min_value=1, max_value=53)
+    try:
+        week_days = hent_uke_dager(kontekst.df, year, week_number)
+    except ValueError as e:
+        st.warning(f"Uke {week_number} finnes ikke i {year}: {e}")
+        return
+
+    bestillinger = []
+    try:
+        uke_grafer(kontekst, week_days, year, week_number, bestillinger)
+    finally:
+        vis_bestilte_grafer(kontekst, bestillinger)
+
 
-    if not daglig_data:
+def uke_grafer(kontekst, week_days, year, week_number, bestillinger):
+    vis_utelatte_dager(week_days)
+    for dag, row in week_days[week_days['gyldig']].iterrows():
+        # Format with month as text
+        formatted_date = dag.strftime("%d. %B %Y")
+        # Print in Norwegian style
+        st.write(f"Dato: {formatted_date}")
+
+        graf_type = "enkeltgraf"
+        lag_graph(kontekst, row, dag.date(), graf_type, bestillinger,
+                  arsak_rad(kontekst, "arsaker_dager", arsak_dager, dag))
+
+    uker = avledet(kontekst, "uker", ukesnitt)
+    if (year, week_number) not in uker.index:
         st.warning("Ingen gyldige data funnet for den valgte uken.")
         return
-    
 
     # Weekly
-    avg_stopptid = np.mean([data[1] for data in daglig_data])
-    avg_arbeidstimer = np.mean([data[2] for data in daglig_data])
-    avg_antall_fisk = np.mean([data[3] for data in daglig_data])
-
-    avg_stopptid_impact = avg_stopptid * oee_100
-    avg_stopptid_takt = round(avg_stopptid_impact / avg_arbeidstimer, 2)
-    avg_faktisk_takt = round(avg_antall_fisk / avg_arbeidstimer, 2)
-    avg_kjente_faktorer = round(avg_stopptid_takt, 2)
-    avg_annet = oee_100 - avg_kjente_faktorer - avg_faktisk_takt
-    avg_annet = round(avg_annet, 2)
     graf_type = "ukesnitt"
     
-    lag_graph(
-        avg_annet,
-        avg_faktisk_takt, avg_stopptid_takt,
-        week_number, graf_type
-        )
+    arsaker = arsak_rad(kontekst, "arsaker_uker", arsak_ukesnitt, (year, week_number))
+    lag_graph(kontekst, uker.loc[(year, week_number)], week_number, graf_type, bestillinger, arsaker)
+    if arsaker is not None:
+        lag_pareto(kontekst, arsaker, week_number, graf_type, bestillinger)
     
     
-def maned(): 
+@malt_fragment
+def maned(kontekst):
     year = st.number_input("Velg år:", min_value=2024, max_value=datetime.now().year)
-    months = ["Velg måned", "Januar", "Februar", "Mars", "April", "Mai", "Juni", 
-              "Juli", "August", "September", "Oktober", "November", "Desember"]
+    months = ["Velg måned"] + MANEDSNAVN
     selected_month = st.selectbox("Velg måned:", months)
     
     # Check if a valid month is selected
@@ -459,107 +1207,335 @@ def maned():
         return
     else:
         month_number = months.index(selected_month)
-        month_days = hent_maned_dager(year, month_number)
+        month_days = hent_maned_dager(kontekst.df, year, month_number)
     
-        if not month_days:
+        if month_days.empty:
             st.warning(f"Ingen produksjonsdager funnet for {selected_month} {year}.")
         else:
             st.write(f"Fant {len(month_days)} produksjonsdager for {selected_month} {year}")
     
-    nedtrekk = ["Velg alternativ","Alle grafene","Kun månedlig gjennomsnitt"]
+    nedtrekk = ["Velg alternativ","Alle grafene","Månedsoversikt i én figur","Kun månedlig gjennomsnitt"]
     graf_valg = st.selectbox("Vil du ha alle grafene eller kun månedlig gjennomsnitt?",nedtrekk)
     
-    year = str(year)
-    tittel = selected_month + " " + year
+    tittel = selected_month + " " + str(year)
     
-    daglig_data = []
-    for dag in month_days:
-        row = df[df['Dato'] == dag].iloc[0]
-        
-        # Print in Norwegian style
-        stopptid = beregn_stopptid(row)
-        arbeidstimer, antall_fisk = beregn_faktiskproduksjon(row)
-        if stopptid is not None and arbeidstimer is not None and antall_fisk is not None:
-            daglig_data.append((dag, stopptid, arbeidstimer, antall_fisk))
+    vis_utelatte_dager(month_days)
     
     if graf_valg == "Velg alternativ":
         st.warning("Vennligst velg et alternativ for å fortsette.")
         return
     
-    elif graf_valg == "Alle grafene":
+    bestillinger = []
+    if graf_valg == "Alle grafene":
         
-        for i in range(len(daglig_data)):
+        for dag, row in kpi_tabell(month_days).iterrows():
             # Plot daily graph
-            st.write(f"Total stopptid i minutter: {round(daglig_data[i][1],2)}")
-            st.write(f"Totale arbeidstimer: {round(daglig_data[i][2]/60,2)}")
-            stopptid_impact = daglig_data[i][1] * oee_100
-            stopptid_takt = round(stopptid_impact / daglig_data[i][2], 2)
-            faktisk_takt = round(daglig_data[i][3] / daglig_data[i][2], 2)
-            kjente_faktorer = round(stopptid_takt, 2)
-            annet = oee_100 - kjente_faktorer - faktisk_takt
-            annet = round(annet, 2)
+            st.write(f"Total stopptid i minutter: {round(row['stopptid'],2)}")
+            st.write(f"Totale arbeidstimer: {round(row['arbeidstimer']/60,2)}")
             graf_type = "enkeltgraf"
             
-            lag_graph(
-                annet,
-                faktisk_takt, stopptid_takt,
-                daglig_data[i][0], graf_type
-                )
+            lag_graph(kontekst, row, dag.date(), graf_type, bestillinger,
+                      arsak_rad(kontekst, "arsaker_dager", arsak_dager, dag))
+
+    elif graf_valg == "Månedsoversikt i én figur":
+
+        lag_maned_oversikt(kontekst, kpi_tabell(month_days), tittel)
 
     # Print separator for monthly average
     st.write("---")
     st.header(f"Oppsummering for {selected_month} {year}")
 
-    # Calculate monthly averages
-    avg_stopptid = np.mean([data[1] for data in daglig_data])
-    avg_arbeidstimer = np.mean([data[2] for data in daglig_data])
-    avg_antall_fisk = np.mean([data[3] for data in daglig_data])
-
-    avg_stopptid_impact = avg_stopptid * oee_100
-    avg_stopptid_takt = round(avg_stopptid_impact / avg_arbeidstimer, 2)
-    avg_faktisk_takt = round(avg_antall_fisk / avg_arbeidstimer, 2)
-    avg_kjente_faktorer = round(avg_stopptid_takt, 2)
-    avg_annet = oee_100 - avg_kjente_faktorer - avg_faktisk_takt
-    avg_annet = round(avg_annet, 2)
-    graf_type = "manedsnitt"
-    
-    lag_graph(
-        avg_annet,
-        avg_faktisk_takt, avg_stopptid_takt,
-        tittel, graf_type)
+    maneder = avledet(kontekst, "maneder", manedsnitt)
+    if (year, month_number) not in maneder.index:
+        st.warning(f"Ingen gyldige data funnet for {selected_month} {year}.")
+    else:
+        graf_type = "manedsnitt"
         
-    
+        arsaker = arsak_rad(kontekst, "arsaker_maneder", arsak_manedsnitt, (year, month_number))
+        lag_graph(kontekst, maneder.loc[(year, month_number)], tittel, graf_type, bestillinger, arsaker)
+        if arsaker is not None:
+            lag_pareto(kontekst, arsaker, tittel, graf_type, bestillinger)
+
+    vis_bestilte_grafer(kontekst, bestillinger)
+
+
+ROLLERENDE_UKER = [4, 13, 52]
+
+
+@malt_fragment
+def periode(kontekst):
+    df = kontekst.df
+    if not len(df):
+        st.warning("Ingen produksjonsdager i historikken.")
+        return
+    # Every number below is looked up in the cumulative sums, so changing the
+    # period or the window does not go through the days again
+    summer = avledet(kontekst, "periodesummer", hent_periodesummer)
+    forste, siste = df.index.min().date(), df.index.max().date()
+
+    valg = st.selectbox("Velg periode:", ["Fra og til", "Kvartal"])
+    if valg == "Kvartal":
+        year = st.number_input("Velg år:", min_value=forste.year, max_value=siste.year, value=siste.year)
+        kvartal = st.selectbox("Velg kvartal:", [1, 2, 3, 4], format_func=lambda x: f"{x}. kvartal")
+        fra = date(year, 3 * kvartal - 2, 1)
+        til = date(year + (kvartal == 4), (3 * kvartal) % 12 + 1, 1) - timedelta(days=1)
+    else:
+        fra, til = st.slider(
+            "Fra og til:", min_value=forste, max_value=siste,
+            value=(max(forste, siste - timedelta(weeks=13) + timedelta(days=1)), siste), format="DD.MM.YYYY")
+    uker = st.selectbox("Rullerende gjennomsnitt over:", ROLLERENDE_UKER, index=1, format_func=lambda x: f"{x} uker")
+
+    tittel = f"{fra:%d.%m.%Y}–{til:%d.%m.%Y}"
+    kpi = periode_kpi(summer, fra, til, kontekst.ark_type).iloc[0]
+    if not kpi['antall_dager']:
+        st.warning(f"Ingen gyldige data funnet for {tittel}.")
+        return
+    st.write(f"Fant {int(kpi['antall_dager'])} produksjonsdager med gyldige verdier for {tittel}")
+    st.write(f"Gjennomsnittlig stopptid i minutter: {round(kpi['stopptid'], 2)}")
+    st.write(f"Gjennomsnittlige arbeidstimer: {round(kpi['arbeidstimer'] / 60, 2)}")
+    arsaker = periode_arsaker(summer, fra, til, kontekst.ark_type).iloc[0] if kontekst.detaljert else None
+    lag_graph(kontekst, kpi, tittel, "periode", arsaker=arsaker)
+    if arsaker is not None:
+        lag_pareto(kontekst, arsaker, tittel, "periode")
+
+    # The rolling average on each production day of the period, with a straight-line trend
+    dager = kpi_tabell(hent_periode(df, fra, til)).index
+    rullerende = rullerende_kpi(summer, dager, uker, kontekst.ark_type)
+    graf = pd.DataFrame({f"Faktisk takt, {uker} uker": rullerende['faktisk_takt'],
+                         f"Stopptid takt, {uker} uker": rullerende['stopptid_takt']})
+    if len(dager) > 1:
+        x = ((dager - dager[0]) / pd.Timedelta(days=1)).to_numpy(dtype=float)
+        stigning, konstant = np.polyfit(x, rullerende['faktisk_takt'].to_numpy(), 1)
+        graf["Trend, faktisk takt"] = stigning * x + konstant
+        st.write(f"Trend for faktisk takt: {stigning * 7:+.2f} per minutt per uke")
+    st.line_chart(graf)
+
+
+ALLE_ARSAKER = "Alle årsaker"
+
+
+@malt_fragment
+def scenarioer(kontekst):
+    ark_type = kontekst.ark_type
+    df = kontekst.df
+    if not df['gyldig'].any():
+        st.warning("Ingen produksjonsdager med gyldige verdier i historikken.")
+        return
+    st.write("Endre kapasitet (100 % OEE), mål og hvor mange prosent av hver stoppårsak som fjernes. "
+             "Minuttene som spares regnes som produksjon i dagens tempo når linjen går.")
+    navn = arsaknavn(ark_type)
+    kolonner = {
+        "Kapasitet": st.column_config.NumberColumn("Kapasitet", min_value=0.0, format="%.1f"),
+        "Mål": st.column_config.NumberColumn("Mål", min_value=0.0, format="%.1f"),
+    }
+    for arsak in navn:
+        kolonner[arsak] = st.column_config.NumberColumn(arsak, min_value=0.0, max_value=100.0, format="%.0f %%")
+    scenarier = st.data_editor(standard_scenarier(ark_type), num_rows="dynamic", hide_index=True,
+                               column_config=kolonner, key=f"scenarier_{ark_type}")
+
+    with st.expander("Sveip over én årsak"):
+        arsak = st.selectbox("Årsak:", ["Ingen", ALLE_ARSAKER] + navn)
+        steg = st.number_input("Steg (%):", min_value=1, max_value=50, value=10)
+    if arsak != "Ingen":
+        scenarier = pd.concat([scenarier, sveip_scenarier(ark_type, arsak, steg)], ignore_index=True)
+
+    # Rows being typed in may still have empty cells
+    scenarier = scenarier.dropna(subset=["Kapasitet", "Mål"])
+    scenarier = scenarier.fillna({arsak: 0.0 for arsak in navn}).fillna({"Scenario": ""})
+    if scenarier.empty:
+        st.warning("Legg inn minst ett scenario.")
+        return
+
+    grunnlag = avledet(kontekst, "scenariogrunnlag", scenariogrunnlag)
+    tabell = scenario_tabell(grunnlag, scenarier, ark_type)
+    st.write(f"Gjennomsnitt over {len(grunnlag['datoer'])} produksjonsdager, "
+             f"{grunnlag['datoer'].min():%d.%m.%Y}–{grunnlag['datoer'].max():%d.%m.%Y}")
+    st.dataframe(tabell, hide_index=True)
+
+    _, ylabel = graf_tekster(None, "periode", ark_type)
+    rader = tuple(
+        (str(rad["Scenario"]), float(rad["Stopptid takt"]), float(rad["Annet"]), float(rad["Faktisk takt"]),
+         float(rad["Kapasitet"]), float(rad["Mål"]))
+        for _, rad in tabell.iterrows()
+    )
+    vis_graf(kontekst, ("scenarier", rader, f"Scenarioer på {ark_type}", ylabel))
+
+
+EKSPORTER = [
+    ("xlsx", "Excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ("csv", "CSV (zip)", "application/zip"),
+    ("parquet", "Parquet (zip)", "application/zip"),
+]
+
+
+def vis_eksport(alle, ark_type):
+    # Every loaded day of every line; the file is only made when a button is clicked
+    with st.sidebar.expander("Eksporter nøkkeltall"):
+        st.caption("Daglige nøkkeltall og ukes- og månedsgjennomsnitt for alle dager i historikken.")
+        for filformat, etikett, mime in EKSPORTER:
+            endelse = "xlsx" if filformat == "xlsx" else "zip"
+            st.download_button(
+                etikett, data=lambda filformat=filformat: eksport_bytes(eksport_tabeller(alle, ark_type), filformat),
+                file_name=f"nokkeltall_{ark_type}.{endelse}", mime=mime, on_click="ignore")
+
+
+def vis_kvalitetsrapport(rapport, ark_type):
+    # The days of the upload that failed the quality checks, in one place
+    if rapport.empty:
+        return
+    dager = rapport.drop_duplicates([kolonne for kolonne in ['Dato', 'linje'] if kolonne in rapport])
+    st.warning(f"{len(dager)} dager i historikken er utelatt fra beregningene fordi de ikke besto datakontrollen.")
+    with st.expander("Datakvalitet"):
+        st.dataframe(rapport['melding'].value_counts().rename_axis("Kontroll").reset_index(name="Dager"), hide_index=True)
+        st.dataframe(rapport, hide_index=True)
+        st.download_button("Last ned som CSV", rapport.to_csv(index=False), file_name=f"datakvalitet_{ark_type}.csv",
+                           mime="text/csv", on_click="ignore")
+
+
+#------------------------------
+#     DIAGNOSTIKK
+#------------------------------
+
+def diagnostikk_tabell(steg):
+    # One row per measured stage, slowest first
+    tabell = pd.DataFrame.from_dict(steg, orient="index", columns=["sekunder", "antall", "topp_mb"])
+    tabell.index.name = "steg"
+    return tabell.sort_values("sekunder", ascending=False).reset_index()
+
+
+def vis_diagnostikk(steg, kontekst=None):
+    tabell = diagnostikk_tabell(steg)
+    datasett = None if kontekst is None else kontekst.df
+    antall_delte, antall_andeler = delte_datasett_status()
+    info = {
+        "tidspunkt": datetime.now().isoformat(timespec="seconds"),
+        "ark": None if kontekst is None else kontekst.ark_type,
+        "analyse": st.session_state.get("analysis_type"),
+        "dager": 0 if datasett is None else len(datasett),
+        "delte_datasett": antall_delte,
+        "okter_med_datasett": antall_andeler,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+    }
+    with st.sidebar.expander("Diagnostikk", expanded=True):
+        st.dataframe(tabell, hide_index=True)
+        st.caption("topp_mb gjelder hele prosessen, så økter som kjører samtidig, telles med. "
+                   "Når en rapport oppdateres alene, vises målingene under rapporten.")
+        st.download_button("Last ned som JSON", json.dumps({**info, "steg": tabell.to_dict("records")}, indent=2, ensure_ascii=False),
+                           file_name="diagnostikk.json", mime="application/json")
+        st.download_button("Last ned som CSV", tabell.assign(**info)[[*info, *tabell.columns]].to_csv(index=False),
+                           file_name="diagnostikk.csv", mime="text/csv")
+
+
+# In the order the first run with a file needs them
+TUNGE_MODULER = ["numpy", "pandas", "pyarrow", "pyarrow.parquet", "openpyxl", "PIL.Image", "matplotlib.figure"]
+
+
+def varm_opp():
+    # Imports the heavy modules and draws one chart, so matplotlib's font cache and
+    # backend are set up before the first real chart. Any error is left for the code
+    # that needs the module to report.
+    try:
+        for navn in TUNGE_MODULER:
+            importlib.import_module(navn)
+        tegn_graf_png(1.0, 1.0, 1.0, "", "", "slakt", OEE_100["slakt"], STIPLET_HOYDE["slakt"])
+    except Exception:
+        pass
+
+
+@st.cache_resource(show_spinner=False)
+def _oppvarming():
+    # Once per server process, in the background while the first page is drawn and
+    # the user picks a file
+    trad = threading.Thread(target=varm_opp, name="oppvarming", daemon=True)
+    trad.start()
+    return trad
+
+
 def main():
+    _oppvarming()
+    diagnostikk = st.sidebar.checkbox(
+        "Vis diagnostikk", key="diagnostikk",
+        help="Tid, antall kall og minnetopp for hvert steg i denne kjøringen.")
+    # Time and call counts are always measured; peak memory only while the panel is on
+    start_maling(minne=diagnostikk)
+    kontekst = None
+    try:
+        with maal("hele kjøringen"):
+            kontekst = produksjonsanalyse()
+    finally:
+        steg = stopp_maling()
+        if diagnostikk:
+            vis_diagnostikk(steg, kontekst)
+
+
+def tom_lagret_historikk(ark_type, linjer):
+    # Runs before the rerun, so the confirmation can be taken back for the next time
+    tom_lager(ark_type, linjer)
+    glem_datasett()
+    st.session_state["bekreft_tom_lager"] = False
+
+
+def produksjonsanalyse():
+    # Returns the analysis context of this run
     st.title("Produksjonsanalyse")
-    global sheet_type
     sheet_type = st.selectbox("Velg type ark:", ["slakt", "filet"])
 
 
-    uploaded_file = st.file_uploader(f"Velg en Excel-fil (må være et 'input-{sheet_type}'-ark).", type=["xlsx"])
-    analysis_type = st.selectbox("Velg analyse:", ["Spesifikk dato", "Ukesrapport", "Månedsrapport"])
-    global oee_100
-    oee_100 = 150 if sheet_type == "slakt" else 25
-    global stiplet_hoyde
-    stiplet_hoyde = 120 if sheet_type == "slakt" else 20
+    uploaded_files = st.file_uploader(
+        f"Velg en Excel-fil (må være et 'input-{sheet_type}'-ark), eller én fil per linje.",
+        type=["xlsx"], accept_multiple_files=True)
+    analysis_type = st.selectbox(
+        "Velg analyse:", ["Spesifikk dato", "Ukesrapport", "Månedsrapport", "Egendefinert periode", "Scenarioer"],
+        key="analysis_type")
+    parallell_rendering = st.sidebar.checkbox(
+        "Tegn grafer parallelt", help="Tegner mange grafer samtidig i flere prosesser (uke- og månedsrapport).")
+    interaktive_grafer = st.sidebar.checkbox(
+        "Interaktive grafer", help="Grafene tegnes i nettleseren og viser verdiene når du holder over en søyle. "
+                                   "Raskere med mange brukere; bildene trengs bare for eksport.")
+    detaljert = st.sidebar.checkbox(
+        "Del opp stopptid på årsaker", help="Viser hver stoppårsak som et eget steg i grafene, "
+                                            "og et Pareto-diagram over årsakene for uke, måned og periode.")
+    kontekst = Analysekontekst(sheet_type, parallell_rendering, interaktive_grafer, detaljert)
 
-    if uploaded_file is None:
+    if not uploaded_files:
         st.warning("Vennligst last opp en Excel-fil for å fortsette.")
-        return
+        return kontekst
+
+    if len(uploaded_files) > 1:
+        _, kollisjoner = linjenavn([f.name for f in uploaded_files])
+        if kollisjoner:
+            st.warning("Flere filer har samme navn og er lest inn som hver sin linje:\n\n" + "\n".join(
+                f"- {filnavn}: {', '.join(navn)}" for filnavn, navn in kollisjoner.items())
+                + "\n\nGi filene ulike navn, så hver linje beholder sin egen lagrede historikk.")
 
-    # Load and process the data
-    global df
-    df = les_data(uploaded_file)
+    # Only the stores of the lines in this upload, and only once confirmed
+    linjer = linjenavn([f.name for f in uploaded_files])[0] if len(uploaded_files) > 1 else [None]
+    with st.sidebar.expander("Lagret historikk"):
+        bekreftet = st.checkbox(
+            "Slett historikken til filene som er lastet opp", key="bekreft_tom_lager",
+            help="Dagene som er lagret fra tidligere opplastinger av disse filene, slettes for godt.")
+        st.button(f"Tøm lagret historikk for {sheet_type}", disabled=not bekreftet,
+                  on_click=tom_lagret_historikk, args=(sheet_type, linjer))
+
+    # Merge the upload into the stored history and report on all stored days
+    df, feil = hent_datasett(sheet_type, uploaded_files)
+    if feil:
+        st.error("Noen filer ble hoppet over:\n\n" + "\n\n".join(f"{linje}: {melding}" for linje, melding in feil))
     if df is None:
         st.warning("Ingen data tilgjengelig i den opplastede filen. Vennligst last opp en gyldig Excel-fil.")
-        return
-
-    # Ensure 'Dato' column exists
-    try:
-        df.iloc[:, 0] = pd.to_datetime(df.iloc[:, 0], format="%Y-%m-%d %H:%M:%S")
-        df['Dato'] = df.iloc[:, 0].dt.date
-    except ValueError as e:
-        st.error(f"Feil ved behandling av datoer: {e}")
-        return
+        return kontekst
+    vis_kvalitetsrapport(st.session_state["datasett"]["andel"].kvalitet, sheet_type)
+    linje = None
+    if len(uploaded_files) > 1:
+        # The reports show one line at a time
+        linje = st.sidebar.selectbox("Velg linje:", list(dict.fromkeys(df['linje'])))
+        df = df[df['linje'] == linje]
+    df = velg_analysedata(kontekst, df, (st.session_state["datasett"]["nokkel"], linje))
+    if len(df):
+        st.sidebar.caption(f"Historikk for {sheet_type}: {len(df)} dager, "
+                           f"{df.index.min():%d.%m.%Y}–{df.index.max():%d.%m.%Y}.")
+        vis_eksport(st.session_state["datasett"]["andel"].df, sheet_type)
 
     #------------------------------
     #          ENKELT DAG
@@ -567,7 +1543,7 @@ def main():
 
     if analysis_type == "Spesifikk dato":
         
-        enkelt_dato()
+        enkelt_dato(kontekst)
         
     #------------------------------
     #          UKESRAPPORT
@@ -575,14 +1551,30 @@ def main():
     
     elif analysis_type == "Ukesrapport":
         
-        uke()   
+        uke(kontekst)   
         
     #------------------------------    
     #         MÅNEDSRAPPORT
     #------------------------------
-    else:            
+    elif analysis_type == "Månedsrapport":
         
-        maned()
+        maned(kontekst)
+
+    #------------------------------
+    #      EGENDEFINERT PERIODE
+    #------------------------------
+    elif analysis_type == "Egendefinert periode":
+
+        periode(kontekst)
+
+    #------------------------------
+    #          SCENARIOER
+    #------------------------------
+    else:
+
+        scenarioer(kontekst)
+
+    return kontekst
                 
             
 if __name__ == "__main__":